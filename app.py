@@ -3,31 +3,174 @@ import sys
 
 import re
 import random
+import sqlite3
 import string
+import atexit
+import hashlib
+import json
+import queue
+import threading
+import time
+from collections import Counter, OrderedDict
 from datetime import datetime, timedelta
-from flask import Flask, render_template, redirect, url_for, flash, request, jsonify, session
+from functools import lru_cache, wraps
+from flask import Flask, Response, render_template, send_from_directory, redirect, url_for, flash, request, jsonify, session, g, has_request_context
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session as FlaskSession
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.security import generate_password_hash, check_password_hash, safe_join
 from werkzeug.utils import secure_filename
-from PIL import Image
-from sqlalchemy import or_, and_
+from PIL import Image, ImageOps
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import or_, and_, case, event, false, func, inspect, literal, literal_column, text, union_all, update
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import aliased, joinedload, make_transient_to_detached, with_loader_criteria
 from markupsafe import Markup, escape
 from urllib.parse import quote
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'azayuur_secret_key_2026'    
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///azaunur.db'
+# БД: по умолчанию SQLite-файл в instance/, DATABASE_URL переключает на серверную (postgresql://...)
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///azaunur.db').replace(
+    'postgres://', 'postgresql://', 1)
+app.config['DB_POOL_SIZE'] = int(os.environ.get('DB_POOL_SIZE', 10))
+app.config['DB_MAX_OVERFLOW'] = int(os.environ.get('DB_MAX_OVERFLOW', 20))
+app.config['DB_BUSY_RETRIES'] = 3  # повторы записи при «database is locked»
+# Движок для маршрутов с @read_only: реплика из DATABASE_READ_URL, для SQLite-файла по умолчанию —
+# тот же файл в режиме mode=ro (в WAL читатели не ждут писателя)
+app.config['DATABASE_READ_URI'] = os.environ.get('DATABASE_READ_URL')
+app.config['SQLITE_PRAGMAS'] = {
+    'journal_mode': 'WAL',  # читатели не ждут писателя
+    'synchronous': 'NORMAL',  # в WAL без риска повредить базу
+    'busy_timeout': 5000,  # мс ожидания блокировки вместо мгновенной ошибки
+    'cache_size': -32000,  # ~32 МБ страничного кэша на соединение
+    'mmap_size': 268435456,
+    'temp_store': 'MEMORY',
+}
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['UPLOAD_FOLDER'] = 'static/uploads/avatars'
 app.config['UPLOAD_FOLDER_POSTS'] = 'static/uploads/posts'
-
-db = SQLAlchemy(app)
+app.config['UPLOAD_FOLDER_ORIGINALS'] = os.path.join(app.instance_path, 'originals')  # исходники загрузок, не раздаются
+app.config['IMAGE_WORKERS'] = 2  # потоки обработки картинок; 0 — обрабатывать прямо в запросе
+# Отдача /media: None — сам Flask; 'x-sendfile' — Apache/lighttpd; 'x-accel' — nginx, internal-location
+# MEDIA_ACCEL_PREFIX должна смотреть в каталоги загрузок (…/posts/, …/avatars/)
+app.config['MEDIA_SENDFILE'] = os.environ.get('MEDIA_SENDFILE')
+app.config['MEDIA_ACCEL_PREFIX'] = '/_media/'
+app.config['USE_X_SENDFILE'] = app.config['MEDIA_SENDFILE'] == 'x-sendfile'
+app.config['VIEW_FLUSH_INTERVAL'] = 2  # секунды между пачками записей просмотров
+app.config['REDIS_URL'] = os.environ.get('REDIS_URL')  # задан — кэши общие для всех воркеров
+app.config['BLOCK_CACHE_TTL'] = 300
+app.config['PRESENCE_FLUSH_INTERVAL'] = 30  # секунды между записями last_seen в БД
+app.config['IDENTITY_CACHE_TTL'] = 60  # секунды жизни кэша текущего пользователя
+# Удаление постов: '1' — пост сразу скрывается (deleted_at), а зависимые строки чистит фоновый поток
+app.config['DEFERRED_DELETE'] = os.environ.get('DEFERRED_DELETE') == '1'
+app.config['PURGE_INTERVAL'] = 30  # секунды между проходами фоновой очистки
+# Лента «Подписки»: посты авторов раскладываются по лентам подписчиков при записи; аккаунт, переросший
+# FANOUT_LIMIT подписчиков, лента дочитывает сама при чтении, пока тот не опустится ниже FANOUT_RESUME
+app.config['FANOUT_LIMIT'] = 5000
+app.config['FANOUT_RESUME'] = 4000
+app.config['TIMELINE_BACKFILL'] = 50  # сколько последних постов автора попадает в ленту при подписке
+app.config['QUERY_STATS'] = os.environ.get('QUERY_STATS') == '1'  # заголовок X-DB-Queries и лог на каждый запрос
+
+_db_uri = app.config['SQLALCHEMY_DATABASE_URI']
+if _db_uri in ('sqlite://', 'sqlite:///:memory:'):
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {}  # одно общее соединение (StaticPool), размер пула не задаётся
+elif _db_uri.startswith('sqlite'):
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_size': app.config['DB_POOL_SIZE'],
+        'max_overflow': app.config['DB_MAX_OVERFLOW'],
+        'pool_timeout': 10,
+        'connect_args': {'check_same_thread': False},  # соединения берут и фоновые потоки
+    }
+else:
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_size': app.config['DB_POOL_SIZE'],
+        'max_overflow': app.config['DB_MAX_OVERFLOW'],
+        'pool_timeout': 10,
+        'pool_pre_ping': True,
+        'pool_recycle': 1800,
+    }
+
+_read_uri = app.config['DATABASE_READ_URI']
+if not _read_uri and _db_uri.startswith('sqlite:///') and _db_uri != 'sqlite:///:memory:' and '?' not in _db_uri:
+    _read_uri = 'sqlite:///file:' + _db_uri[len('sqlite:///'):] + '?mode=ro&uri=true'
+if _read_uri:
+    app.config['SQLALCHEMY_BINDS'] = {'read': _read_uri}
+
+
+class RoutingSession(FlaskSession):
+    """Разводка чтения и записи: в запросах, помеченных @read_only, SELECT идут через движок 'read';
+    flush и UPDATE/INSERT/DELETE — всегда в основную БД."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if (bind is None and not self._flushing and not getattr(clause, 'is_dml', False)
+                and has_request_context() and g.get('db_read_only')):
+            read_engine = self._db.engines.get('read')
+            if read_engine is not None:
+                return read_engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+db = SQLAlchemy(app, session_options={'class_': RoutingSession})
 login_manager = LoginManager(app)
 login_manager.login_view = 'login'
 
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 os.makedirs(app.config['UPLOAD_FOLDER_POSTS'], exist_ok=True)
+os.makedirs(app.config['UPLOAD_FOLDER_ORIGINALS'], exist_ok=True)
+
+
+@event.listens_for(Engine, 'connect')
+def _sqlite_pragmas(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    for name, value in app.config['SQLITE_PRAGMAS'].items():
+        try:
+            cursor.execute(f'PRAGMA {name}={value}')
+        except sqlite3.OperationalError:
+            # соединение mode=ro не может сменить journal_mode — это делает основное
+            if name != 'journal_mode':
+                raise
+    cursor.close()
+
+
+def is_busy_error(exc):
+    return isinstance(exc, OperationalError) and any(
+        msg in str(exc.orig) for msg in ('database is locked', 'database is busy'))
+
+
+def retry_on_busy(view):
+    """Повторяет запись, если SQLite так и не дождался блокировки (busy_timeout истёк или конфликт
+    двух транзакций, начатых на чтение). Между попытками — откат и пауза с экспоненциальным ростом.
+    View повторяется целиком, поэтому в нём должен быть ровно один commit на ветку: иначе повтор
+    после удачного первого commit запишет его изменения второй раз."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        retries = app.config['DB_BUSY_RETRIES']
+        for attempt in range(retries + 1):
+            try:
+                return view(*args, **kwargs)
+            except OperationalError as e:
+                if attempt == retries or not is_busy_error(e):
+                    raise
+                db.session.rollback()
+                app.logger.warning('БД занята, повтор %d из %d: %s', attempt + 1, retries, request.path)
+                time.sleep(0.05 * 2 ** attempt * random.uniform(0.5, 1.5))
+    return wrapper
+
+
+def read_only(view):
+    """Маршрут только читает БД: его GET/HEAD обслуживает движок 'read' (см. RoutingSession)."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if request.method in ('GET', 'HEAD'):
+            g.db_read_only = True
+        return view(*args, **kwargs)
+    return wrapper
+
 
 # --- MODELS ---
 class User(UserMixin, db.Model):
@@ -43,18 +186,24 @@ class User(UserMixin, db.Model):
     is_admin = db.Column(db.Boolean, default=False)
     banned_until = db.Column(db.DateTime, nullable=True)
     last_seen = db.Column(db.DateTime, nullable=True)
+    # Денормализованные счётчики: меняются через bump_counter, чинятся командой flask recount
+    follower_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    follows_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    post_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    unread_notifications = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    fanout_pulled_at = db.Column(db.DateTime, nullable=True)  # с этого момента посты не раскладываются (sync_fanout_mode)
 
     def is_banned(self):
         return self.banned_until and self.banned_until > datetime.utcnow()
 
     def followers_count(self):
-        return Follow.query.filter_by(following_id=self.id).count()
+        return self.follower_count or 0
 
     def following_count(self):
-        return Follow.query.filter_by(follower_id=self.id).count()
+        return self.follows_count or 0
 
     def posts_count(self):
-        return Post.query.filter_by(user_id=self.id).count()
+        return self.post_count or 0
 
 
 class VerificationRequest(db.Model):
@@ -70,21 +219,33 @@ class Post(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     body = db.Column(db.Text, nullable=False)
     image = db.Column(db.String(200), nullable=True)
+    image_status = db.Column(db.String(20), nullable=True)  # processing / ready / failed; None — без фото
+    image_original = db.Column(db.String(200), nullable=True)  # исходник в UPLOAD_FOLDER_ORIGINALS
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     edited_at = db.Column(db.DateTime, nullable=True)
+    deleted_at = db.Column(db.DateTime, nullable=True)  # мягкое удаление (DEFERRED_DELETE), ждёт purge_posts
+    like_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    comment_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    repost_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    view_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
     user = db.relationship('User', backref=db.backref('posts', lazy='dynamic'))
+    __table_args__ = (
+        db.Index('ix_post_user_created', 'user_id', 'created_at'),  # профиль
+        db.Index('ix_post_created', 'created_at'),  # лента
+        db.Index('ix_post_deleted', 'deleted_at'),  # фоновая очистка
+    )
 
     def likes_count(self):
-        return PostLike.query.filter_by(post_id=self.id).count()
+        return self.like_count or 0
 
     def comments_count(self):
-        return Comment.query.filter_by(post_id=self.id).count()
+        return self.comment_count or 0
 
     def reposts_count(self):
-        return Repost.query.filter_by(post_id=self.id).count()
+        return self.repost_count or 0
 
     def views_count(self):
-        return PostView.query.filter_by(post_id=self.id).count()
+        return self.view_count or 0
 
     def ordered_comments(self):
         return self.comments.order_by(Comment.created_at.asc()).all()
@@ -95,7 +256,10 @@ class Follow(db.Model):
     follower_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     following_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    __table_args__ = (db.UniqueConstraint('follower_id', 'following_id', name='uq_follow'),)
+    __table_args__ = (
+        db.UniqueConstraint('follower_id', 'following_id', name='uq_follow'),
+        db.Index('ix_follow_following', 'following_id', 'created_at'),  # подписчики
+    )
 
 
 class PostLike(db.Model):
@@ -103,7 +267,10 @@ class PostLike(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     post_id = db.Column(db.Integer, db.ForeignKey('post.id'), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    __table_args__ = (db.UniqueConstraint('user_id', 'post_id', name='uq_post_like'),)
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'post_id', name='uq_post_like'),
+        db.Index('ix_post_like_post', 'post_id'),
+    )
 
 
 class Comment(db.Model):
@@ -117,16 +284,24 @@ class Comment(db.Model):
     user = db.relationship('User', backref=db.backref('comments', lazy='dynamic'))
     parent_id = db.Column(db.Integer, db.ForeignKey('comment.id'), nullable=True)
     parent = db.relationship('Comment', remote_side=[id], backref=db.backref('replies', lazy='dynamic'))
+    like_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    __table_args__ = (
+        db.Index('ix_comment_post_parent', 'post_id', 'parent_id'),  # верхние комментарии поста
+        db.Index('ix_comment_parent', 'parent_id'),  # ответы
+    )
 
     def likes_count(self):
-        return CommentLike.query.filter_by(comment_id=self.id).count()
+        return self.like_count or 0
 
 
 class CommentLike(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     comment_id = db.Column(db.Integer, db.ForeignKey('comment.id'), nullable=False)
-    __table_args__ = (db.UniqueConstraint('user_id', 'comment_id', name='uq_comment_like'),)
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'comment_id', name='uq_comment_like'),
+        db.Index('ix_comment_like_comment', 'comment_id'),
+    )
 
 
 class Repost(db.Model):
@@ -136,7 +311,12 @@ class Repost(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     post = db.relationship('Post', backref=db.backref('reposts', lazy='dynamic'))
     user = db.relationship('User', backref=db.backref('reposts', lazy='dynamic'))
-    __table_args__ = (db.UniqueConstraint('user_id', 'post_id', name='uq_repost'),)
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'post_id', name='uq_repost'),
+        db.Index('ix_repost_created', 'created_at'),  # лента
+        db.Index('ix_repost_post', 'post_id'),
+        db.Index('ix_repost_user_created', 'user_id', 'created_at'),  # репосты автора в «Подписках»
+    )
 
 
 class PostView(db.Model):
@@ -155,7 +335,27 @@ class Notification(db.Model):
     comment_id = db.Column(db.Integer, db.ForeignKey('comment.id'), nullable=True)
     read = db.Column(db.Boolean, default=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Склейка однотипных уведомлений: «A, B и ещё 48 лайкнули ваш пост»
+    actor_count = db.Column(db.Integer, default=1, server_default='1', nullable=False)
+    actor_ids = db.Column(db.String(200), nullable=True)  # последние авторы через запятую, новые первыми
     from_user = db.relationship('User', foreign_keys=[from_user_id])
+    __table_args__ = (
+        db.Index('ix_notification_user_read', 'user_id', 'read', 'created_at'),  # непрочитанные, склейка
+        db.Index('ix_notification_user_created', 'user_id', 'created_at'),  # список уведомлений
+        db.Index('ix_notification_post', 'post_id'),
+        db.Index('ix_notification_comment', 'comment_id'),  # удаление комментария
+    )
+
+    def recent_actor_ids(self):
+        if not self.actor_ids:
+            return [self.from_user_id] if self.from_user_id else []
+        return [int(x) for x in self.actor_ids.split(',') if x]
+
+
+class NotificationActor(db.Model):
+    """Кто уже учтён в actor_count склеенного уведомления (actor_ids хранит только последних)."""
+    notification_id = db.Column(db.Integer, db.ForeignKey('notification.id'), primary_key=True, autoincrement=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True, autoincrement=False)
 
 
 class Message(db.Model):
@@ -165,6 +365,32 @@ class Message(db.Model):
     body = db.Column(db.Text, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     read = db.Column(db.Boolean, default=False)
+    __table_args__ = (db.Index('ix_message_pair', 'sender_id', 'receiver_id', 'id'),)  # переписка, страницы по id
+
+
+class Conversation(db.Model):
+    """Сводка диалога для /chats: одна строка на пару пользователей (user_a_id < user_b_id)."""
+    id = db.Column(db.Integer, primary_key=True)
+    user_a_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_b_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    last_message_id = db.Column(db.Integer, db.ForeignKey('message.id'), nullable=True)
+    last_at = db.Column(db.DateTime, nullable=True)
+    unread_a = db.Column(db.Integer, default=0, server_default='0', nullable=False)  # непрочитанные у user_a
+    unread_b = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    user_a = db.relationship('User', foreign_keys=[user_a_id])
+    user_b = db.relationship('User', foreign_keys=[user_b_id])
+    last_message = db.relationship('Message', foreign_keys=[last_message_id])
+    __table_args__ = (
+        db.UniqueConstraint('user_a_id', 'user_b_id', name='uq_conversation'),
+        db.Index('ix_conversation_a_last', 'user_a_id', 'last_at'),
+        db.Index('ix_conversation_b_last', 'user_b_id', 'last_at'),
+    )
+
+    def peer_of(self, user_id):
+        return self.user_b if user_id == self.user_a_id else self.user_a
+
+    def unread_for(self, user_id):
+        return self.unread_a if user_id == self.user_a_id else self.unread_b
 
 
 class Report(db.Model):
@@ -183,7 +409,10 @@ class Block(db.Model):
     blocker_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     blocked_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    __table_args__ = (db.UniqueConstraint('blocker_id', 'blocked_id', name='uq_block'),)
+    __table_args__ = (
+        db.UniqueConstraint('blocker_id', 'blocked_id', name='uq_block'),
+        db.Index('ix_block_blocked', 'blocked_id'),  # «кто заблокировал меня»
+    )
 
 
 class SavedPost(db.Model):
@@ -191,7 +420,58 @@ class SavedPost(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     post_id = db.Column(db.Integer, db.ForeignKey('post.id'), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    __table_args__ = (db.UniqueConstraint('user_id', 'post_id', name='uq_saved_post'),)
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'post_id', name='uq_saved_post'),
+        db.Index('ix_saved_post_user_created', 'user_id', 'created_at'),  # закладки
+        db.Index('ix_saved_post_post', 'post_id'),
+    )
+
+
+class Hashtag(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), unique=True, nullable=False)  # в нижнем регистре, без '#'
+
+
+class PostHashtag(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    post_id = db.Column(db.Integer, db.ForeignKey('post.id'), nullable=False)
+    hashtag_id = db.Column(db.Integer, db.ForeignKey('hashtag.id'), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)  # копия Post.created_at для ленты тега и трендов
+    __table_args__ = (
+        db.UniqueConstraint('post_id', 'hashtag_id', name='uq_post_hashtag'),
+        db.Index('ix_post_hashtag_tag_created', 'hashtag_id', 'created_at'),
+    )
+
+
+class Mention(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)  # кого упомянули
+    from_user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    post_id = db.Column(db.Integer, db.ForeignKey('post.id'), nullable=False)
+    comment_id = db.Column(db.Integer, db.ForeignKey('comment.id'), nullable=True)  # None — упоминание в самом посте
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    __table_args__ = (
+        db.Index('ix_mention_user_created', 'user_id', 'created_at'),
+        db.Index('ix_mention_post_comment', 'post_id', 'comment_id'),
+        db.Index('ix_mention_comment', 'comment_id'),
+    )
+
+
+class TimelineEntry(db.Model):
+    """Лента «Подписки» (fan-out on write): строка в ленте каждого подписчика на новый пост или репост."""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)  # чья лента
+    kind = db.Column(db.SmallInteger, nullable=False)  # FEED_KIND_POST / FEED_KIND_REPOST
+    item_id = db.Column(db.Integer, nullable=False)  # Post.id или Repost.id
+    post_id = db.Column(db.Integer, db.ForeignKey('post.id'), nullable=False)
+    author_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)  # автор поста или репоста
+    ts = db.Column(db.DateTime, nullable=False)
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'kind', 'item_id', name='uq_timeline_entry'),
+        db.Index('ix_timeline_user_ts', 'user_id', 'ts', 'kind', 'item_id'),  # страница ленты
+        db.Index('ix_timeline_user_author', 'user_id', 'author_id'),  # отписка
+        db.Index('ix_timeline_post', 'post_id', 'kind', 'item_id'),  # удаление поста, отмена репоста
+    )
 
 
 class EmailVerificationCode(db.Model):
@@ -208,6 +488,13 @@ class PasswordResetCode(db.Model):
     expires_at = db.Column(db.DateTime, nullable=False)
 
 
+class SchemaMigration(db.Model):
+    """Применённые миграции схемы (см. MIGRATIONS)."""
+    version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    name = db.Column(db.String(100), nullable=False)
+    applied_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
 # Предустановленные статусы (админ выбирает из списка или вводит свой)
 PREDEFINED_STATUSES = [
     'Пикми', 'Король', 'Королева', 'Легенда', 'Икона', 'Звезда', 'Огонь', 'Топ',
@@ -221,41 +508,583 @@ PREDEFINED_STATUSES = [
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    return load_identity(int(user_id))
 
 
 @app.before_request
-def update_last_seen():
-    if current_user.is_authenticated:
-        now = datetime.utcnow()
-        if not current_user.last_seen or (now - current_user.last_seen).total_seconds() > 60:
-            current_user.last_seen = now
-            db.session.commit()
+def authenticate_request():
+    """Единый вход запроса: пользователь из identity-кэша, затем бан и отметка присутствия — без запросов к БД."""
+    if not current_user.is_authenticated:
+        return
+    if current_user.is_banned():
+        logout_user()
+        flash('Ваш аккаунт заблокирован. Ожидайте окончания блокировки.')
+        return redirect(url_for('login'))
+    presence.touch(current_user.id)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context():
+        g.db_queries = g.get('db_queries', 0) + 1
+
+
+@app.after_request
+def report_query_count(response):
+    if app.config['QUERY_STATS']:
+        count = g.get('db_queries', 0)
+        response.headers['X-DB-Queries'] = str(count)
+        app.logger.info('%s %s: %d запросов к БД', request.method, request.path, count)
+    return response
 
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in {'png', 'jpg', 'jpeg', 'gif'}
 
 
+NOTIFY_COALESCE_TYPES = {'like', 'repost', 'follow'}
+NOTIFY_COALESCE_WINDOW = timedelta(hours=6)
+NOTIFY_RECENT_ACTORS = 3
+
+
 def notify(user_id, from_user_id, ntype, post_id=None, comment_id=None):
+    """Лайки, репосты и подписки склеиваются с непрочитанным уведомлением того же типа и поста
+    за NOTIFY_COALESCE_WINDOW — вместо тысячи строк одна, поднятая наверх."""
     if user_id == from_user_id:
         return
-    n = Notification(user_id=user_id, from_user_id=from_user_id, type=ntype, post_id=post_id, comment_id=comment_id)
-    db.session.add(n)
+    n = None
+    if ntype in NOTIFY_COALESCE_TYPES:
+        n = Notification.query.filter(
+            Notification.user_id == user_id, Notification.type == ntype, Notification.post_id == post_id,
+            Notification.read.is_(False), Notification.created_at >= datetime.utcnow() - NOTIFY_COALESCE_WINDOW
+        ).order_by(Notification.created_at.desc()).first()
+    if n is not None:
+        if _add_notification_actor(n.id, from_user_id):
+            n.actor_count = (n.actor_count or 1) + 1
+        actors = [from_user_id] + [a for a in n.recent_actor_ids() if a != from_user_id]
+        n.actor_ids = ','.join(str(a) for a in actors[:NOTIFY_RECENT_ACTORS])
+        n.from_user_id = from_user_id
+        n.created_at = datetime.utcnow()
+        unread = None  # непрочитанных не прибавилось
+    else:
+        n = Notification(user_id=user_id, from_user_id=from_user_id, type=ntype, post_id=post_id,
+                         comment_id=comment_id, actor_count=1, actor_ids=str(from_user_id))
+        db.session.add(n)
+        if ntype in NOTIFY_COALESCE_TYPES:
+            db.session.flush()
+            _add_notification_actor(n.id, from_user_id)
+        unread = bump_counter(User.unread_notifications, user_id, 1)
+    publish_event(user_id, 'notification', {'type': ntype, 'from_user_id': from_user_id, 'post_id': post_id,
+                                            'unread': unread})
+
+
+def _add_notification_actor(notification_id, user_id):
+    """True, если user_id ещё не был учтён в этом уведомлении (повторный лайк после отмены — не новый автор)."""
+    return db.session.execute(insert_ignore(NotificationActor).values(
+        notification_id=notification_id, user_id=user_id)).rowcount > 0
+
+
+def bump_counter(column, obj_id, delta):
+    """Атомарно сдвигает денормализованный счётчик (напр. Post.like_count) в текущей транзакции.
+    Возвращает новое значение — повторный COUNT для ответа не нужен."""
+    model = column.class_
+    if model is User:
+        stale_identity(obj_id)
+    return db.session.execute(
+        db.update(model).where(model.id == obj_id)
+        .values({column.key: func.coalesce(column, 0) + delta})
+        .returning(column)
+    ).scalar()
+
+
+def rebuild_counters():
+    """Пересчитывает все денормализованные счётчики из исходных таблиц (на случай расхождений)."""
+    def count_of(model, fk, target):
+        return db.select(func.count()).select_from(model).where(fk == target).scalar_subquery()
+    db.session.execute(db.update(Post).values(
+        like_count=count_of(PostLike, PostLike.post_id, Post.id),
+        comment_count=count_of(Comment, Comment.post_id, Post.id),
+        repost_count=count_of(Repost, Repost.post_id, Post.id),
+        view_count=count_of(PostView, PostView.post_id, Post.id),
+    ))
+    db.session.execute(db.update(Comment).values(
+        like_count=count_of(CommentLike, CommentLike.comment_id, Comment.id),
+    ))
+    db.session.execute(db.update(User).values(
+        follower_count=count_of(Follow, Follow.following_id, User.id),
+        follows_count=count_of(Follow, Follow.follower_id, User.id),
+        post_count=db.select(func.count()).select_from(Post)
+        .where(Post.user_id == User.id, Post.deleted_at.is_(None)).scalar_subquery(),
+        unread_notifications=db.select(func.count()).select_from(Notification)
+        .where(Notification.user_id == User.id, Notification.read.isnot(True)).scalar_subquery(),
+    ))
+    db.session.commit()
+
+
+@app.cli.command('recount')
+def recount_command():
+    """Пересобрать счётчики лайков, репостов, комментариев, просмотров, подписок и непрочитанных уведомлений."""
+    rebuild_counters()
+    rebuild_conversations()
+    print('Счётчики и сводки диалогов пересчитаны.')
+
+
+def insert_ignore(model):
+    """INSERT, который молча пропускает строки, нарушающие уникальность (INSERT OR IGNORE / ON CONFLICT DO NOTHING)."""
+    dialect = postgresql if db.engine.dialect.name == 'postgresql' else sqlite
+    return dialect.insert(model).on_conflict_do_nothing()
+
+
+class ViewRecorder:
+    """Буфер просмотров постов. Запрос только кладёт пары (post_id, user_id) в память,
+    фоновый поток раз в interval секунд пишет их пачками INSERT OR IGNORE и двигает view_count."""
+
+    BATCH_ROWS = 400  # 2 параметра на строку — с запасом под лимит переменных SQLite
+    MAX_ATTEMPTS = 3  # после стольких неудачных записей подряд пачка отбрасывается
+
+    def __init__(self, interval=2, max_pending=5000, remember=100000):
+        self.interval = interval
+        self.max_pending = max_pending
+        self.remember = remember
+        self._pending = set()
+        self._recent = OrderedDict()  # уже записанные пары, чтобы не гонять их в БД повторно
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._failures = 0
+
+    def record(self, user_id, post_ids):
+        with self._lock:
+            for pid in post_ids:
+                key = (pid, user_id)
+                if key not in self._recent:
+                    self._pending.add(key)
+            overflow = len(self._pending) >= self.max_pending
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='view-recorder', daemon=True)
+                self._thread.start()
+        if overflow:
+            self._wakeup.set()
+
+    def flush(self):
+        """Записывает накопленное. Вызывается в app context; возвращает число новых просмотров."""
+        with self._lock:
+            batch, self._pending = self._pending, set()
+        if not batch:
+            return 0
+        inserted = Counter()
+        try:
+            if self._failures:
+                # повтор после ошибки: частая причина — пост удалён, пока просмотр ждал в буфере
+                live = set(db.session.execute(db.select(Post.id).where(
+                    Post.id.in_({pid for pid, _ in batch}))).scalars())
+                batch = {key for key in batch if key[0] in live}
+            rows = [{'post_id': pid, 'user_id': uid} for pid, uid in batch]
+            for i in range(0, len(rows), self.BATCH_ROWS):
+                stmt = insert_ignore(PostView).values(rows[i:i + self.BATCH_ROWS]).returning(PostView.post_id)
+                inserted.update(db.session.execute(stmt).scalars())
+            for pid, n in inserted.items():
+                bump_counter(Post.view_count, pid, n)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            self._failures += 1
+            if self._failures >= self.MAX_ATTEMPTS:
+                self._failures = 0
+                app.logger.error('Просмотры не записаны (попыток: %d), отброшено: %d', self.MAX_ATTEMPTS, len(batch))
+                raise
+            with self._lock:
+                # назад в буфер, но не больше max_pending: свежие просмотры важнее застрявших
+                room = max(self.max_pending - len(self._pending), 0)
+                if room < len(batch):
+                    app.logger.warning('Буфер просмотров переполнен, отброшено: %d', len(batch) - room)
+                    batch = set(list(batch)[:room])
+                self._pending |= batch
+            raise
+        self._failures = 0
+        with self._lock:
+            for key in batch:
+                self._recent[key] = True
+            while len(self._recent) > self.remember:
+                self._recent.popitem(last=False)
+        return sum(inserted.values())
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            try:
+                with app.app_context():
+                    self.flush()
+            except Exception:
+                app.logger.exception('Не удалось записать просмотры')
+
+
+view_recorder = ViewRecorder(app.config['VIEW_FLUSH_INTERVAL'])
+
+
+@atexit.register
+def _flush_views_on_exit():
+    with app.app_context():
+        view_recorder.flush()
+
+
+_redis_client = None
+
+
+def get_redis():
+    """Клиент Redis для общих кэшей; None, если REDIS_URL не задан. Пакет redis нужен только в этом случае."""
+    global _redis_client
+    if _redis_client is None and app.config.get('REDIS_URL'):
+        import redis
+        _redis_client = redis.Redis.from_url(app.config['REDIS_URL'])
+    return _redis_client
+
+
+class TTLCache:
+    """Кэш ключ→значение с временем жизни. По умолчанию в памяти процесса (не больше max_entries ключей),
+    при REDIS_URL — общий для всех воркеров. Значения должны сериализоваться в JSON."""
+
+    def __init__(self, prefix, ttl, max_entries=10000):
+        self.prefix = prefix
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        r = get_redis()
+        if r is not None:
+            raw = r.get(f'{self.prefix}:{key}')
+            return json.loads(raw) if raw is not None else None
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            return value
+
+    def set(self, key, value):
+        r = get_redis()
+        if r is not None:
+            r.set(f'{self.prefix}:{key}', json.dumps(value), ex=self.ttl)
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, *keys):
+        r = get_redis()
+        if r is not None:
+            if keys:
+                r.delete(*(f'{self.prefix}:{k}' for k in keys))
+            return
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+
+block_cache = TTLCache('blocks', app.config['BLOCK_CACHE_TTL'])
+
+
+ONLINE_WINDOW = 120  # секунды: кого видели позже — «в сети»
+
+
+class PresenceTracker:
+    """Отметки «был в сети». Запрос только обновляет словарь в памяти (и хэш в Redis, если он есть),
+    фоновый поток раз в interval секунд пишет накопленное в user.last_seen одним пакетным UPDATE."""
+
+    REDIS_KEY = 'presence'
+
+    def __init__(self, interval=30, keep=600):
+        self.interval = interval
+        self.keep = keep  # столько секунд записанная отметка ещё живёт в памяти
+        self._seen = {}
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def touch(self, user_id):
+        now = datetime.utcnow()
+        r = get_redis()
+        if r is not None:
+            r.hset(self.REDIS_KEY, user_id, now.isoformat())
+        with self._lock:
+            self._seen[user_id] = now
+            self._dirty.add(user_id)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='presence', daemon=True)
+                self._thread.start()
+
+    def last_seen(self, user):
+        """Свежая отметка из памяти/Redis, иначе — записанная в БД."""
+        with self._lock:
+            seen = self._seen.get(user.id)
+        if seen is None:
+            r = get_redis()
+            raw = r.hget(self.REDIS_KEY, user.id) if r is not None else None
+            if raw is not None:
+                seen = datetime.fromisoformat(raw.decode())
+        if seen is None or (user.last_seen and user.last_seen > seen):
+            return user.last_seen
+        return seen
+
+    def is_online(self, user):
+        seen = self.last_seen(user)
+        return seen is not None and (datetime.utcnow() - seen).total_seconds() < ONLINE_WINDOW
+
+    def flush(self):
+        """Пишет накопленные отметки. Вызывается в app context; возвращает число обновлённых пользователей."""
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+            rows = [{'id': uid, 'last_seen': self._seen[uid]} for uid in dirty]
+        if not rows:
+            return 0
+        try:
+            db.session.execute(update(User), rows)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            with self._lock:
+                self._dirty |= dirty
+            raise
+        cutoff = datetime.utcnow() - timedelta(seconds=self.keep)
+        with self._lock:
+            for uid in [uid for uid, seen in self._seen.items() if seen < cutoff and uid not in self._dirty]:
+                del self._seen[uid]
+        return len(rows)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                with app.app_context():
+                    self.flush()
+            except Exception:
+                app.logger.exception('Не удалось записать last_seen')
+
+
+presence = PresenceTracker(app.config['PRESENCE_FLUSH_INTERVAL'])
+
+
+@atexit.register
+def _flush_presence_on_exit():
+    with app.app_context():
+        presence.flush()
+
+
+identity_cache = TTLCache('identity', app.config['IDENTITY_CACHE_TTL'])
+IDENTITY_SKIP = {'password'}  # хэш пароля в кэш не кладём — подгрузится из БД при обращении
+
+
+def load_identity(user_id):
+    """Текущий пользователь для Flask-Login. Строка User берётся из identity_cache и подключается к сессии
+    через merge(load=False) — без SELECT; изменения по-прежнему сохраняются обычным commit."""
+    row = identity_cache.get(user_id)
+    if row is None:
+        user = db.session.get(User, user_id)
+        if user is not None:
+            identity_cache.set(user_id, {
+                attr.key: value.isoformat() if isinstance(value, datetime) else value
+                for attr in inspect(User).column_attrs if attr.key not in IDENTITY_SKIP
+                for value in [getattr(user, attr.key)]
+            })
+        return user
+    values = {}
+    for attr in inspect(User).column_attrs:
+        if attr.key in IDENTITY_SKIP:
+            continue
+        value = row.get(attr.key)
+        if value is not None and isinstance(attr.columns[0].type, db.DateTime):
+            value = datetime.fromisoformat(value)
+        values[attr.key] = value
+    user = User(**values)
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
+
+
+def stale_identity(*user_ids):
+    """Сбросить кэш пользователей после commit текущей транзакции."""
+    db.session.info.setdefault('stale_identities', set()).update(user_ids)
+
+
+@event.listens_for(db.session, 'after_flush')
+def _collect_stale_identities(sess, flush_context):
+    # Любое изменение строки User (настройки, бан, выдача прав/галочки) сбрасывает её кэш
+    ids = {obj.id for obj in sess.dirty if isinstance(obj, User)}
+    if ids:
+        sess.info.setdefault('stale_identities', set()).update(ids)
+
+
+@event.listens_for(db.session, 'after_commit')
+def _drop_stale_identities(sess):
+    ids = sess.info.pop('stale_identities', None)
+    if ids:
+        identity_cache.delete(*ids)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _forget_stale_identities(sess):
+    sess.info.pop('stale_identities', None)
+
+
+def _block_lists(user_id):
+    """{'out': кого заблокировал user_id, 'in': кто заблокировал его}. Один запрос на промах кэша,
+    в пределах запроса — из g, между запросами — из block_cache (сбрасывается в block_user)."""
+    memo = g.setdefault('block_lists', {}) if has_request_context() else {}
+    if user_id in memo:
+        return memo[user_id]
+    entry = block_cache.get(user_id)
+    if entry is None:
+        rows = db.session.query(Block.blocker_id, Block.blocked_id) \
+            .filter(or_(Block.blocker_id == user_id, Block.blocked_id == user_id)).all()
+        entry = {'out': [b for a, b in rows if a == user_id], 'in': [a for a, b in rows if b == user_id]}
+        block_cache.set(user_id, entry)
+    memo[user_id] = entry
+    return entry
+
+
+def invalidate_blocks(*user_ids):
+    block_cache.delete(*user_ids)
+    if has_request_context():
+        for uid in user_ids:
+            g.setdefault('block_lists', {}).pop(uid, None)
+
+
+def touch_conversation(message):
+    """Обновляет сводку диалога после вставки сообщения (в той же транзакции; message уже с id)."""
+    a, b = sorted((message.sender_id, message.receiver_id))
+    db.session.execute(insert_ignore(Conversation).values(user_a_id=a, user_b_id=b))
+    unread = Conversation.unread_a if message.receiver_id == a else Conversation.unread_b
+    db.session.execute(db.update(Conversation)
+                       .where(Conversation.user_a_id == a, Conversation.user_b_id == b)
+                       .values({Conversation.last_message_id: message.id, Conversation.last_at: message.created_at,
+                                unread: unread + 1}))
+
+
+def mark_conversation_read(user_id, peer_id):
+    """Сбрасывает непрочитанные user_id в диалоге с peer_id. Пишет в БД, только если было что сбрасывать."""
+    a, b = sorted((user_id, peer_id))
+    unread = Conversation.unread_a if user_id == a else Conversation.unread_b
+    result = db.session.execute(db.update(Conversation)
+                                .where(Conversation.user_a_id == a, Conversation.user_b_id == b, unread > 0)
+                                .values({unread: 0}))
+    if result.rowcount:
+        Message.query.filter_by(sender_id=peer_id, receiver_id=user_id, read=False) \
+            .update({'read': True}, synchronize_session=False)
+        db.session.commit()
+
+
+def rebuild_conversations():
+    """Пересобирает таблицу Conversation из всех сообщений."""
+    a = case((Message.sender_id < Message.receiver_id, Message.sender_id), else_=Message.receiver_id)
+    b = case((Message.sender_id < Message.receiver_id, Message.receiver_id), else_=Message.sender_id)
+    unread_a = func.sum(case((and_(Message.receiver_id == a, Message.read.isnot(True)), 1), else_=0))
+    unread_b = func.sum(case((and_(Message.receiver_id == b, Message.read.isnot(True)), 1), else_=0))
+    rows = db.session.query(a, b, func.max(Message.id), unread_a, unread_b).group_by(a, b).all()
+    last_at = dict(db.session.query(Message.id, Message.created_at)
+                   .filter(Message.id.in_([r[2] for r in rows])).all()) if rows else {}
+    Conversation.query.delete()
+    db.session.add_all(Conversation(user_a_id=ua, user_b_id=ub, last_message_id=mid, last_at=last_at.get(mid),
+                                    unread_a=na or 0, unread_b=nb or 0) for ua, ub, mid, na, nb in rows)
+    db.session.commit()
+
+
+class EventBroker:
+    """Pub/sub для SSE: канал на пользователя, у каждого открытого /events — своя очередь.
+    Без REDIS_URL работает в памяти процесса; с ним события идут через Redis pub/sub
+    (подойдёт любой Redis-совместимый сервер), и подписчик получит их в каком бы воркере ни сидел."""
+
+    QUEUE_SIZE = 100
+
+    def __init__(self):
+        self._subscribers = {}  # user_id -> set(queue.Queue)
+        self._lock = threading.Lock()
+        self._listener = None
+
+    def publish(self, user_id, event_type, data):
+        message = {'user_id': user_id, 'type': event_type, 'data': data}
+        r = get_redis()
+        if r is not None:
+            r.publish(f'events:{user_id}', json.dumps(message))
+        else:
+            self._deliver(message)
+
+    def _deliver(self, message):
+        with self._lock:
+            queues = list(self._subscribers.get(message['user_id'], ()))
+        for q in queues:
+            try:
+                q.put_nowait(message)
+            except queue.Full:
+                pass  # клиент не успевает читать — лучше потерять событие, чем копить память
+
+    def subscribe(self, user_id):
+        q = queue.Queue(self.QUEUE_SIZE)
+        with self._lock:
+            self._subscribers.setdefault(user_id, set()).add(q)
+            if get_redis() is not None and (self._listener is None or not self._listener.is_alive()):
+                self._listener = threading.Thread(target=self._listen_redis, name='event-broker', daemon=True)
+                self._listener.start()
+        return q
+
+    def unsubscribe(self, user_id, q):
+        with self._lock:
+            subs = self._subscribers.get(user_id)
+            if subs:
+                subs.discard(q)
+                if not subs:
+                    del self._subscribers[user_id]
+
+    def _listen_redis(self):
+        pubsub = get_redis().pubsub(ignore_subscribe_messages=True)
+        pubsub.psubscribe('events:*')
+        for raw in pubsub.listen():
+            try:
+                self._deliver(json.loads(raw['data']))
+            except (ValueError, KeyError, TypeError):
+                app.logger.warning('Битое событие в Redis: %r', raw)
+
+
+broker = EventBroker()
+
+
+def publish_event(user_id, event_type, data):
+    """Событие пользователю; подписчикам уходит только после успешного commit текущей транзакции."""
+    db.session.info.setdefault('pending_events', []).append((user_id, event_type, data))
+
+
+@event.listens_for(db.session, 'after_commit')
+def _publish_pending_events(sess):
+    for args in sess.info.pop('pending_events', []):
+        broker.publish(*args)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _drop_pending_events(sess):
+    sess.info.pop('pending_events', None)
 
 
 def get_blocked_user_ids(user_id):
     """Возвращает set id пользователей, с которыми user_id не должен видеть контент друг друга (кто кого заблокировал)."""
-    blocked_by_me = {b.blocked_id for b in Block.query.filter_by(blocker_id=user_id).all()}
-    blocked_me = {b.blocker_id for b in Block.query.filter_by(blocked_id=user_id).all()}
-    return blocked_by_me | blocked_me
+    lists = _block_lists(user_id)
+    return set(lists['out']) | set(lists['in'])
+
+
+def is_blocking(viewer_id, target_id):
+    """viewer_id сам заблокировал target_id."""
+    return target_id in _block_lists(viewer_id)['out']
 
 
 def is_blocked(viewer_id, target_id):
     if viewer_id == target_id:
         return False
-    return (Block.query.filter_by(blocker_id=viewer_id, blocked_id=target_id).first() is not None or
-            Block.query.filter_by(blocker_id=target_id, blocked_id=viewer_id).first() is not None)
+    return target_id in get_blocked_user_ids(viewer_id)
 
 
 
@@ -264,34 +1093,1366 @@ def is_blocked(viewer_id, target_id):
     # T: подключить SMTP (flask-mail или smtplib) по app.config.get('MAIL_SERVER')
 
 
+HASHTAG_RE = re.compile(r'#([a-zA-Zа-яА-ЯёЁ0-9_]+)')
+MENTION_RE = re.compile(r'@([a-zA-Z0-9_]+)')
+LINKIFY_CACHE_SIZE = 4096
+
+
+def _repl_hashtag(m):
+    tag = m.group(1)
+    return f'<a href="/tag/{quote(tag)}" class="hashtag">#{tag}</a>'
+
+
+@lru_cache(maxsize=LINKIFY_CACHE_SIZE)
+def _linkify_cached(text):
+    text = escape(text)
+    text = HASHTAG_RE.sub(_repl_hashtag, text)
+    text = MENTION_RE.sub(r'<a href="/u/\1" class="mention">@\1</a>', text)
+    return Markup(text)
+
+
 def linkify_post(text):
-    """Делает #тег и @username кликабельными ссылками. Возвращает Markup (безопасно для вывода в шаблоне)."""
+    """Делает #тег и @username кликабельными ссылками. Возвращает Markup (безопасно для вывода в шаблоне).
+    Результат кэшируется по самому тексту: после правки поста/комментария ключ другой, старая запись вытесняется LRU."""
     if not text:
         return Markup('')
-    text = escape(text)
-    def repl_hashtag(m):
-        tag = m.group(1)
-        return f'<a href="/tag/{quote(tag)}" class="hashtag">#{tag}</a>'
-    text = re.sub(r'#([a-zA-Zа-яА-ЯёЁ0-9_]+)', repl_hashtag, text)
-    text = re.sub(r'@([a-zA-Z0-9_]+)', r'<a href="/u/\1" class="mention">@\1</a>', text)
-    return Markup(text)
+    return _linkify_cached(str(text))
 
 
 def extract_mentions(text):
     """Извлекает список username из текста (упоминания @username)."""
-    return list(set(re.findall(r'@([a-zA-Z0-9_]+)', text)))
+    return list(set(MENTION_RE.findall(text or '')))
+
+
+def extract_hashtags(text):
+    """Хэштеги из текста в нижнем регистре, без '#'."""
+    return sorted({t.lower()[:100] for t in HASHTAG_RE.findall(text or '')})
+
+
+def sync_post_hashtags(post):
+    """Перезаписывает связи пост↔хэштег по текущему body. Пост уже должен иметь id."""
+    PostHashtag.query.filter_by(post_id=post.id).delete(synchronize_session=False)
+    names = extract_hashtags(post.body)
+    if not names:
+        return
+    tag_ids = {h.name: h.id for h in Hashtag.query.filter(Hashtag.name.in_(names))}
+    missing = [n for n in names if n not in tag_ids]
+    if missing:
+        db.session.execute(insert_ignore(Hashtag).values([{'name': n} for n in missing]))
+        tag_ids = {h.name: h.id for h in Hashtag.query.filter(Hashtag.name.in_(names))}
+    db.session.add_all(PostHashtag(post_id=post.id, hashtag_id=tag_ids[n], created_at=post.created_at) for n in names)
+
+
+def sync_mentions(text, from_user_id, post_id, comment_id=None):
+    """Перезаписывает упоминания поста (или комментария) по тексту; все ники разрешаются одним IN.
+    Возвращает id пользователей, упомянутых здесь впервые."""
+    existing = Mention.query.filter_by(post_id=post_id, comment_id=comment_id)
+    old_ids = {m.user_id for m in existing.all()}
+    names = extract_mentions(text)
+    new_ids = {u.id for u in User.query.filter(User.username.in_(names)).all()} if names else set()
+    if old_ids - new_ids:
+        existing.filter(Mention.user_id.in_(old_ids - new_ids)).delete(synchronize_session=False)
+    db.session.add_all(Mention(user_id=uid, from_user_id=from_user_id, post_id=post_id, comment_id=comment_id)
+                       for uid in new_ids - old_ids)
+    return new_ids - old_ids
 
 
 def notify_mentions(text, from_user_id, post_id=None, comment_id=None):
-    for username in extract_mentions(text):
-        u = User.query.filter_by(username=username).first()
-        if u and u.id != from_user_id:
-            notify(u.id, from_user_id, 'mention', post_id=post_id, comment_id=comment_id)
+    for uid in sync_mentions(text, from_user_id, post_id, comment_id):
+        notify(uid, from_user_id, 'mention', post_id=post_id, comment_id=comment_id)
+
+
+def rebuild_tags_and_mentions():
+    """Заполняет PostHashtag и Mention по уже существующим постам и комментариям (без уведомлений)."""
+    for post in Post.query.yield_per(500):
+        sync_post_hashtags(post)
+        sync_mentions(post.body, post.user_id, post.id)
+    for c in Comment.query.yield_per(500):
+        sync_mentions(c.body, c.user_id, c.post_id, c.id)
+    db.session.commit()
+
+
+# Сколько комментариев и ответов показывать в карточке, остальное — по кнопке «Все комментарии»
+COMMENTS_PREVIEW = 3
+REPLIES_PREVIEW = 2
+
+
+def _limited_comment_ids(criterion, partition_col, limit):
+    """id комментариев по criterion, не больше limit + 1 на partition_col (самые залайканные).
+    Лишний +1 нужен только чтобы понять, что тред обрезан."""
+    rn = func.row_number().over(
+        partition_by=partition_col, order_by=(Comment.like_count.desc(), Comment.id.asc())
+    ).label('rn')
+    ranked = db.session.query(Comment.id.label('id'), rn).filter(criterion).subquery()
+    return db.select(ranked.c.id).where(ranked.c.rn <= limit + 1)
+
+
+def load_comment_trees(post_ids, limit=None, replies_limit=None):
+    """Комментарии для пачки постов за два запроса (верхние + ответы, авторы — JOIN-ом).
+    Дерево parent→replies собирается в памяти. limit/replies_limit ограничивают число
+    верхних комментариев на пост и ответов на комментарий; None — весь тред.
+    Возвращает {post_id: {'comments': [...], 'replies': {comment_id: [...]}, 'truncated': bool}}."""
+    post_ids = set(post_ids)
+    trees = {pid: {'comments': [], 'replies': {}, 'truncated': False} for pid in post_ids}
+    if not post_ids:
+        return trees
+
+    criterion = and_(Comment.post_id.in_(post_ids), Comment.parent_id.is_(None))
+    if limit is not None:
+        criterion = Comment.id.in_(_limited_comment_ids(criterion, Comment.post_id, limit))
+    top = Comment.query.options(joinedload(Comment.user)).filter(criterion) \
+        .order_by(Comment.like_count.desc(), Comment.id.asc()).all()
+    for c in top:
+        thread = trees[c.post_id]
+        if limit is not None and len(thread['comments']) >= limit:
+            thread['truncated'] = True
+            continue
+        thread['comments'].append(c)
+    top_ids = {c.id for t in trees.values() for c in t['comments']}
+
+    if top_ids:
+        criterion = Comment.parent_id.in_(top_ids)
+        if replies_limit is not None:
+            criterion = Comment.id.in_(_limited_comment_ids(criterion, Comment.parent_id, replies_limit))
+        replies = Comment.query.options(joinedload(Comment.user)).filter(criterion) \
+            .order_by(Comment.like_count.desc(), Comment.id.asc()).all()
+        for r in replies:
+            thread = trees[r.post_id]
+            siblings = thread['replies'].setdefault(r.parent_id, [])
+            if replies_limit is not None and len(siblings) >= replies_limit:
+                thread['truncated'] = True
+                continue
+            siblings.append(r)
+
+    # В карточке — хронологический порядок, как и раньше
+    by_time = lambda c: (c.created_at or datetime.min, c.id)
+    for thread in trees.values():
+        thread['comments'].sort(key=by_time)
+        for siblings in thread['replies'].values():
+            siblings.sort(key=by_time)
+    return trees
+
+
+# --- ЛЕНТА ---
+FEED_PAGE_SIZE = 20
+
+# kind в ключе сортировки ленты: при равном времени репост идёт выше поста
+FEED_KIND_POST = 0
+FEED_KIND_REPOST = 1
+
+
+def encode_feed_cursor(ts, kind, item_id):
+    return f"{ts.strftime('%Y%m%d%H%M%S%f')}-{kind}-{item_id}"
+
+
+def decode_feed_cursor(cursor):
+    """Разбирает курсор ленты в (created_at, kind, id). Битый курсор — None (первая страница)."""
+    if not cursor:
+        return None
+    try:
+        ts, kind, item_id = cursor.split('-')
+        return datetime.strptime(ts, '%Y%m%d%H%M%S%f'), int(kind), int(item_id)
+    except ValueError:
+        return None
+
+
+def _feed_keyset_filter(ts_col, id_col, kind, cursor):
+    """Условие «строго после курсора» для порядка (ts desc, kind desc, id desc).
+    kind — константа ветки ленты или колонка, если в ветке оба вида."""
+    c_ts, c_kind, c_id = cursor
+    if not isinstance(kind, int):
+        tie = and_(ts_col == c_ts, or_(kind < c_kind, and_(kind == c_kind, id_col < c_id)))
+    elif kind < c_kind:
+        tie = ts_col == c_ts
+    elif kind == c_kind:
+        tie = and_(ts_col == c_ts, id_col < c_id)
+    else:
+        tie = false()
+    return or_(ts_col < c_ts, tie)
+
+
+# SQLite ограничивает число веток одного UNION (SQLITE_MAX_COMPOUND_SELECT = 500)
+FEED_MERGE_FANIN = 100
+
+
+def _merge_feed_pages(pages, limit):
+    """Сливает подзапросы (ts, kind, item_id), каждый уже с LIMIT по своему индексу, в одну страницу:
+    сортируется только их объединение. Длинный список сливается группами по FEED_MERGE_FANIN."""
+    while len(pages) > FEED_MERGE_FANIN:
+        pages = [_merge_feed_pages(pages[i:i + FEED_MERGE_FANIN], limit).subquery()
+                 for i in range(0, len(pages), FEED_MERGE_FANIN)]
+    merged = union_all(*[db.select(page) for page in pages]).subquery()
+    return db.select(merged.c.ts, merged.c.kind, merged.c.item_id) \
+        .order_by(merged.c.ts.desc(), merged.c.kind.desc(), merged.c.item_id.desc()) \
+        .limit(limit + 1)
+
+
+def feed_page_query(blocked_ids, cursor, limit, author_id=None):
+    """SELECT (ts, kind, item_id) одной страницы ленты; cursor — уже разобранный decode_feed_cursor.
+    author_id — только посты и репосты этого пользователя (по его индексам, без сортировки)."""
+    posts_q = db.session.query(
+        Post.created_at.label('ts'), literal(FEED_KIND_POST).label('kind'), Post.id.label('item_id'))
+    reposts_q = db.session.query(
+        Repost.created_at.label('ts'), literal(FEED_KIND_REPOST).label('kind'), Repost.id.label('item_id')
+    ).join(Post, Post.id == Repost.post_id)
+    if author_id is not None:
+        posts_q = posts_q.filter(Post.user_id == author_id)
+        reposts_q = reposts_q.filter(Repost.user_id == author_id)
+    if blocked_ids:
+        posts_q = posts_q.filter(Post.user_id.notin_(blocked_ids))
+        reposts_q = reposts_q.filter(Repost.user_id.notin_(blocked_ids), Post.user_id.notin_(blocked_ids))
+    if cursor:
+        posts_q = posts_q.filter(_feed_keyset_filter(Post.created_at, Post.id, FEED_KIND_POST, cursor))
+        reposts_q = reposts_q.filter(_feed_keyset_filter(Repost.created_at, Repost.id, FEED_KIND_REPOST, cursor))
+    # Каждая ветка отдаёт не больше limit + 1 строк по своему индексу, слияние — уже над ними
+    posts_sq = posts_q.order_by(Post.created_at.desc(), Post.id.desc()).limit(limit + 1).subquery()
+    reposts_sq = reposts_q.order_by(Repost.created_at.desc(), Repost.id.desc()).limit(limit + 1).subquery()
+    return _merge_feed_pages([posts_sq, reposts_sq], limit)
+
+
+def pull_author_ids(viewer_id):
+    """Чьи посты лента «Подписки» читает напрямую: сам пользователь и крупные подписки
+    (fanout_pulled_at задан — им fan_out не пишет)."""
+    big = db.session.execute(
+        db.select(Follow.following_id).join(User, User.id == Follow.following_id)
+        .where(Follow.follower_id == viewer_id, User.fanout_pulled_at.isnot(None))
+    ).scalars().all()
+    return [viewer_id] + big
+
+
+def _fan_out_allowed(author_id):
+    return db.session.execute(db.select(User.fanout_pulled_at).where(User.id == author_id)).scalar() is None
+
+
+_TIMELINE_COLUMNS = ['user_id', 'kind', 'item_id', 'post_id', 'author_id', 'ts']
+
+
+def fan_out(author_id, kind, item_id, post_id, ts):
+    """Кладёт пост/репост в ленты всех подписчиков автора одним INSERT ... SELECT из follow."""
+    if not _fan_out_allowed(author_id):
+        return
+    db.session.execute(insert_ignore(TimelineEntry).from_select(_TIMELINE_COLUMNS, db.select(
+        Follow.follower_id, literal(kind), literal(item_id), literal(post_id), literal(author_id),
+        literal(ts, db.DateTime)).where(Follow.following_id == author_id)))
+
+
+def _fan_out_history(author_ids, since=None):
+    """Посты и репосты author_ids (список или подзапрос id) — в ленты всех их подписчиков; since — только новее."""
+    for kind, model, post_col in ((FEED_KIND_POST, Post, Post.id), (FEED_KIND_REPOST, Repost, Repost.post_id)):
+        query = db.select(Follow.follower_id, literal(kind), model.id, post_col, model.user_id, model.created_at) \
+            .join(model, model.user_id == Follow.following_id).where(model.user_id.in_(author_ids))
+        if since is not None:
+            query = query.where(model.created_at >= since)
+        db.session.execute(insert_ignore(TimelineEntry).from_select(_TIMELINE_COLUMNS, query))
+
+
+def sync_fanout_mode(author_id, followers):
+    """После смены числа подписчиков: больше FANOUT_LIMIT — посты автора дочитываются при чтении,
+    меньше FANOUT_RESUME — снова раскладываются при записи, и подписчикам досылается всё, что автор
+    написал, пока его читали напрямую. Разрыв между порогами не даёт режиму дребезжать."""
+    pulled_at = db.session.execute(db.select(User.fanout_pulled_at).where(User.id == author_id)).scalar()
+    if pulled_at is None and followers > app.config['FANOUT_LIMIT']:
+        value = datetime.utcnow()
+    elif pulled_at is not None and followers < app.config['FANOUT_RESUME']:
+        value = None
+        _fan_out_history([author_id], since=pulled_at)
+    else:
+        return
+    stale_identity(author_id)
+    db.session.execute(db.update(User).where(User.id == author_id).values(fanout_pulled_at=value))
+
+
+def backfill_timeline(user_id, author_id, limit=None):
+    """После подписки: последние посты и репосты автора — в ленту подписчика."""
+    if not _fan_out_allowed(author_id):
+        return
+    limit = limit or app.config['TIMELINE_BACKFILL']
+    for query in (
+            db.select(literal(user_id), literal(FEED_KIND_POST), Post.id, Post.id, Post.user_id, Post.created_at)
+            .where(Post.user_id == author_id).order_by(Post.created_at.desc()).limit(limit),
+            db.select(literal(user_id), literal(FEED_KIND_REPOST), Repost.id, Repost.post_id, Repost.user_id,
+                      Repost.created_at)
+            .where(Repost.user_id == author_id).order_by(Repost.created_at.desc()).limit(limit)):
+        db.session.execute(insert_ignore(TimelineEntry).from_select(_TIMELINE_COLUMNS, query))
+
+
+def rebuild_timelines():
+    """Пересматривает режим всех авторов по текущим порогам и заново раскладывает ленты «Подписки»."""
+    changed = db.session.execute(db.update(User).where(
+        User.fanout_pulled_at.is_(None), User.follower_count > app.config['FANOUT_LIMIT']
+    ).values(fanout_pulled_at=datetime.utcnow()).returning(User.id)).scalars().all()
+    changed += db.session.execute(db.update(User).where(
+        User.fanout_pulled_at.isnot(None), User.follower_count < app.config['FANOUT_RESUME']
+    ).values(fanout_pulled_at=None).returning(User.id)).scalars().all()
+    stale_identity(*changed)
+    db.session.execute(db.delete(TimelineEntry))
+    _fan_out_history(db.select(User.id).where(User.fanout_pulled_at.is_(None)))
+    db.session.commit()
+
+
+@app.cli.command('rebuild-timelines')
+def rebuild_timelines_command():
+    """Пересобрать ленты «Подписки» (например, после смены FANOUT_LIMIT)."""
+    rebuild_timelines()
+    print(f'Строк в лентах: {TimelineEntry.query.count()}')
+
+
+def following_page_query(viewer_id, blocked_ids, cursor, limit):
+    """SELECT (ts, kind, item_id) страницы ленты «Подписки»: готовые строки TimelineEntry
+    плюс посты и репосты pull_author_ids, слитые по времени."""
+    pulled = pull_author_ids(viewer_id)
+    timeline_q = db.session.query(
+        TimelineEntry.ts.label('ts'), TimelineEntry.kind.label('kind'), TimelineEntry.item_id.label('item_id')
+    ).join(Post, Post.id == TimelineEntry.post_id) \
+        .filter(TimelineEntry.user_id == viewer_id, TimelineEntry.author_id.notin_(pulled))
+    if blocked_ids:
+        timeline_q = timeline_q.filter(TimelineEntry.author_id.notin_(blocked_ids), Post.user_id.notin_(blocked_ids))
+    if cursor:
+        timeline_q = timeline_q.filter(
+            _feed_keyset_filter(TimelineEntry.ts, TimelineEntry.item_id, TimelineEntry.kind, cursor))
+    timeline_sq = timeline_q.order_by(
+        TimelineEntry.ts.desc(), TimelineEntry.kind.desc(), TimelineEntry.item_id.desc()).limit(limit + 1).subquery()
+    # По странице на каждого читаемого напрямую автора: IN по всем сразу сортировал бы все их посты
+    pulled_sqs = [feed_page_query(blocked_ids, cursor, limit, author_id=author_id).subquery()
+                  for author_id in pulled if author_id not in blocked_ids]
+    return _merge_feed_pages([timeline_sq] + pulled_sqs, limit)
+
+
+def get_feed_page(viewer_id, cursor=None, limit=FEED_PAGE_SIZE, following=False):
+    """Одна страница ленты: посты и репосты сливаются по времени в SQL (keyset, без OFFSET).
+    following — только подписки (following_page_query).
+    Возвращает (feed_items, next_cursor); feed_items в формате шаблона: (kind, post, repost|None)."""
+    blocked_ids = get_blocked_user_ids(viewer_id)
+    cursor = decode_feed_cursor(cursor)
+    if following:
+        query = following_page_query(viewer_id, blocked_ids, cursor, limit)
+    else:
+        query = feed_page_query(blocked_ids, cursor, limit)
+    rows = db.session.execute(query).all()
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    post_ids = [r.item_id for r in rows if r.kind == FEED_KIND_POST]
+    repost_ids = [r.item_id for r in rows if r.kind == FEED_KIND_REPOST]
+    posts = {p.id: p for p in Post.query.options(joinedload(Post.user)).filter(Post.id.in_(post_ids)).all()} if post_ids else {}
+    reposts = {r.id: r for r in Repost.query.options(
+        joinedload(Repost.user), joinedload(Repost.post).joinedload(Post.user)
+    ).filter(Repost.id.in_(repost_ids)).all()} if repost_ids else {}
+
+    feed_items = []
+    for r in rows:
+        if r.kind == FEED_KIND_POST and r.item_id in posts:
+            feed_items.append(('post', posts[r.item_id], None))
+        elif r.kind == FEED_KIND_REPOST and r.item_id in reposts:
+            rp = reposts[r.item_id]
+            feed_items.append(('repost', rp.post, rp))
+    next_cursor = encode_feed_cursor(rows[-1].ts, rows[-1].kind, rows[-1].item_id) if has_more else None
+    return feed_items, next_cursor
+
+
+# --- ТРЕНДЫ ---
+TRENDING_WEIGHTS = {'like': 1, 'comment': 2, 'repost': 3}
+_EPOCH = datetime(1970, 1, 1)
+
+
+class TrendingService:
+    """Скользящее окно активности: корзины по bucket_seconds за window_seconds.
+    Записи (хэштеги новых постов, лайки, комментарии, репосты) инкрементально двигают счётчики,
+    истёкшие корзины вычитаются. Топ хранится готовым и пересортировывается не чаще раза в refresh_seconds.
+    Состояние у каждого процесса своё; при первом обращении окно прогревается из БД."""
+
+    TOP_KEEP = 50
+
+    def __init__(self, bucket_seconds=300, window_seconds=86400, refresh_seconds=30):
+        self.bucket_seconds = bucket_seconds
+        self.n_buckets = window_seconds // bucket_seconds
+        self.refresh_seconds = refresh_seconds
+        self._buckets = {}  # номер корзины -> (Counter хэштегов, Counter постов)
+        self._tags = Counter()
+        self._posts = Counter()
+        self._top_tags = []
+        self._top_posts = []
+        self._top_at = 0.0
+        self._warm = False
+        self._lock = threading.Lock()
+
+    def _bucket_no(self, dt):
+        return int((dt - _EPOCH).total_seconds()) // self.bucket_seconds
+
+    def _expire(self, now_bucket):
+        oldest = now_bucket - self.n_buckets + 1
+        stale = [b for b in self._buckets if b < oldest]
+        for b in stale:
+            tags, posts = self._buckets.pop(b)
+            self._tags.subtract(tags)
+            self._posts.subtract(posts)
+        if stale:
+            self._tags = +self._tags  # выкидываем обнулившиеся ключи
+            self._posts = +self._posts
+            self._top_at = 0.0
+        return oldest
+
+    def _add(self, kind, key, weight, dt):
+        b = self._bucket_no(dt)
+        if b < self._expire(self._bucket_no(datetime.utcnow())):
+            return
+        bucket = self._buckets.setdefault(b, (Counter(), Counter()))
+        if kind == 'tag':
+            bucket[0][key] += weight
+            self._tags[key] += weight
+        else:
+            bucket[1][key] += weight
+            self._posts[key] += weight
+
+    def _bucket_expr(self, col):
+        if db.engine.dialect.name == 'sqlite':
+            return db.cast(func.strftime('%s', col), db.Integer) / self.bucket_seconds
+        return func.floor(func.extract('epoch', col) / self.bucket_seconds)
+
+    def _ensure_warm(self):
+        """Один раз за процесс агрегирует окно из БД по корзинам (GROUP BY), дальше — только инкременты.
+        True — окно загружено этим вызовом: оно уже содержит только что закоммиченное событие."""
+        if self._warm:
+            return False
+        since = datetime.utcnow() - timedelta(seconds=self.bucket_seconds * self.n_buckets)
+        tag_rows = db.session.query(Hashtag.name, self._bucket_expr(PostHashtag.created_at), func.count()) \
+            .join(PostHashtag, PostHashtag.hashtag_id == Hashtag.id) \
+            .filter(PostHashtag.created_at >= since).group_by(Hashtag.name, self._bucket_expr(PostHashtag.created_at)).all()
+        post_rows = []
+        for model, weight in ((PostLike, TRENDING_WEIGHTS['like']), (Comment, TRENDING_WEIGHTS['comment']),
+                              (Repost, TRENDING_WEIGHTS['repost'])):
+            bucket = self._bucket_expr(model.created_at)
+            post_rows += [(pid, b, n * weight) for pid, b, n in db.session.query(model.post_id, bucket, func.count())
+                          .filter(model.created_at >= since).group_by(model.post_id, bucket).all()]
+        with self._lock:
+            if self._warm:
+                return False
+            for kind, rows in (('tag', tag_rows), ('post', post_rows)):
+                for key, b, n in rows:
+                    self._add(kind, key, n, _EPOCH + timedelta(seconds=int(b) * self.bucket_seconds))
+            self._warm = True
+        return True
+
+    def record_tags(self, names, dt=None):
+        """Вызывать после commit: первый вызов в процессе прогревает окно и событие уже в нём."""
+        if self._ensure_warm():
+            return
+        with self._lock:
+            for name in names:
+                self._add('tag', name, 1, dt or datetime.utcnow())
+
+    def record_post(self, post_id, action, dt=None):
+        if self._ensure_warm():
+            return
+        with self._lock:
+            self._add('post', post_id, TRENDING_WEIGHTS[action], dt or datetime.utcnow())
+
+    def _refresh_top(self):
+        now = time.monotonic()
+        with self._lock:
+            self._expire(self._bucket_no(datetime.utcnow()))
+            if now - self._top_at >= self.refresh_seconds:
+                self._top_tags = self._tags.most_common(self.TOP_KEEP)
+                self._top_posts = self._posts.most_common(self.TOP_KEEP)
+                self._top_at = now
+
+    def top_tags(self, k=10):
+        """[(имя, очки)] по убыванию — без запросов к БД после прогрева."""
+        self._ensure_warm()
+        self._refresh_top()
+        return self._top_tags[:k]
+
+    def top_posts(self, k=10):
+        """[(post_id, очки)] по убыванию."""
+        self._ensure_warm()
+        self._refresh_top()
+        return self._top_posts[:k]
+
+
+trending = TrendingService()
+
+
+# --- ПОИСК (SQLite FTS5) ---
+SEARCH_PAGE_SIZE = 30
+
+# '#' и '_' — часть слова: «#тег» ищется точным токеном и не совпадает с «#тегинг»
+_FTS_TOKENIZE = "unicode61 tokenchars '#_'"
+_FTS_DDL = [
+    f"""CREATE VIRTUAL TABLE IF NOT EXISTS post_fts USING fts5(body, content='post', content_rowid='id', tokenize="{_FTS_TOKENIZE}")""",
+    """CREATE TRIGGER IF NOT EXISTS post_fts_ai AFTER INSERT ON post BEGIN
+        INSERT INTO post_fts(rowid, body) VALUES (new.id, new.body); END""",
+    """CREATE TRIGGER IF NOT EXISTS post_fts_ad AFTER DELETE ON post BEGIN
+        INSERT INTO post_fts(post_fts, rowid, body) VALUES ('delete', old.id, old.body); END""",
+    """CREATE TRIGGER IF NOT EXISTS post_fts_au AFTER UPDATE OF body ON post BEGIN
+        INSERT INTO post_fts(post_fts, rowid, body) VALUES ('delete', old.id, old.body);
+        INSERT INTO post_fts(rowid, body) VALUES (new.id, new.body); END""",
+    f"""CREATE VIRTUAL TABLE IF NOT EXISTS user_fts USING fts5(username, content='user', content_rowid='id', tokenize="{_FTS_TOKENIZE}")""",
+    """CREATE TRIGGER IF NOT EXISTS user_fts_ai AFTER INSERT ON "user" BEGIN
+        INSERT INTO user_fts(rowid, username) VALUES (new.id, new.username); END""",
+    """CREATE TRIGGER IF NOT EXISTS user_fts_ad AFTER DELETE ON "user" BEGIN
+        INSERT INTO user_fts(user_fts, rowid, username) VALUES ('delete', old.id, old.username); END""",
+    """CREATE TRIGGER IF NOT EXISTS user_fts_au AFTER UPDATE OF username ON "user" BEGIN
+        INSERT INTO user_fts(user_fts, rowid, username) VALUES ('delete', old.id, old.username);
+        INSERT INTO user_fts(rowid, username) VALUES (new.id, new.username); END""",
+]
+
+# Виртуальные таблицы вне db.metadata — create_all их не трогает, DDL выше
+_fts_metadata = db.MetaData()
+post_fts = db.Table('post_fts', _fts_metadata, db.Column('rowid', db.Integer), db.Column('body', db.Text))
+user_fts = db.Table('user_fts', _fts_metadata, db.Column('rowid', db.Integer), db.Column('username', db.Text))
+_fts_ready = False
+
+
+def ensure_search_index(connection):
+    """Создаёт FTS-таблицы и триггеры синхронизации; при первом создании заполняет индекс."""
+    if connection.dialect.name != 'sqlite':
+        return
+    existed = connection.exec_driver_sql(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'post_fts'").first() is not None
+    for ddl in _FTS_DDL:
+        connection.exec_driver_sql(ddl)
+    if not existed:
+        rebuild_search_index(connection)
+
+
+def rebuild_search_index(connection):
+    connection.exec_driver_sql("INSERT INTO post_fts(post_fts) VALUES ('rebuild')")
+    connection.exec_driver_sql("INSERT INTO user_fts(user_fts) VALUES ('rebuild')")
+
+
+event.listen(db.metadata, 'after_create', lambda target, connection, **kw: ensure_search_index(connection))
+
+
+@app.cli.command('reindex')
+def reindex_command():
+    """Пересобрать полнотекстовый индекс постов и пользователей."""
+    with db.engine.begin() as connection:
+        ensure_search_index(connection)
+        rebuild_search_index(connection)
+    rebuild_tags_and_mentions()
+    print('Поисковый индекс, хэштеги и упоминания пересобраны.')
+
+
+def search_index_ready():
+    """FTS есть только в SQLite и только после ensure_search_index; иначе поиск работает через ILIKE."""
+    global _fts_ready
+    if not _fts_ready and db.engine.dialect.name == 'sqlite':
+        _fts_ready = db.session.execute(db.text(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'post_fts'")).first() is not None
+    return _fts_ready
+
+
+def fts_query(q, prefix=True):
+    """Строка запроса FTS5 из пользовательского ввода: каждое слово в кавычках (никакого синтаксиса
+    от пользователя), последнее — префиксом, чтобы искать по мере набора."""
+    terms = re.findall(r'[#\w]+', q)
+    if not terms:
+        return None
+    parts = [f'"{t}"' for t in terms]
+    if prefix:
+        parts[-1] += '*'
+    return ' '.join(parts)
+
+
+def _fts_ids(table, column, match, limit, offset, join=None, where=()):
+    q = db.select(table.c.rowid).where(column.match(match), *where)
+    if join is not None:
+        q = q.join(*join)
+    return [row[0] for row in db.session.execute(
+        q.order_by(literal_column('rank')).limit(limit).offset(offset)
+    )]
+
+
+def _in_order(model, ids, options=()):
+    """Загружает объекты по id и возвращает их в порядке ids (порядок релевантности из FTS)."""
+    if not ids:
+        return []
+    objs = {o.id: o for o in model.query.options(*options).filter(model.id.in_(ids)).all()}
+    return [objs[i] for i in ids if i in objs]
+
+
+def search_posts(q, limit=SEARCH_PAGE_SIZE, offset=0, exclude_user_ids=()):
+    """Посты по релевантности (bm25). Авторы из exclude_user_ids отсекаются в SQL — страницы остаются полными."""
+    exclude = [Post.user_id.notin_(exclude_user_ids)] if exclude_user_ids else []
+    if not search_index_ready():
+        return Post.query.options(joinedload(Post.user)).filter(Post.body.ilike(f'%{q}%'), *exclude) \
+            .order_by(Post.created_at.desc()).limit(limit).offset(offset).all()
+    match = fts_query(q)
+    if not match:
+        return []
+    join = (Post, Post.id == post_fts.c.rowid) if exclude else None
+    ids = _fts_ids(post_fts, post_fts.c.body, match, limit, offset, join=join, where=exclude)
+    return _in_order(Post, ids, [joinedload(Post.user)])
+
+
+def search_users(q, limit=SEARCH_PAGE_SIZE, offset=0, exclude_user_ids=()):
+    exclude = [User.id.notin_(exclude_user_ids)] if exclude_user_ids else []
+    if not search_index_ready():
+        return User.query.filter(User.username.ilike(f'%{q}%'), *exclude).limit(limit).offset(offset).all()
+    match = fts_query(q)
+    if not match:
+        return []
+    where = [user_fts.c.rowid.notin_(exclude_user_ids)] if exclude_user_ids else []
+    return _in_order(User, _fts_ids(user_fts, user_fts.c.username, match, limit, offset, where=where))
+
+
+def tagged_posts_query(tag):
+    """Посты с точным хэштегом #tag — индексный JOIN по PostHashtag, новые сверху."""
+    return Post.query.join(PostHashtag, PostHashtag.post_id == Post.id) \
+        .join(Hashtag, Hashtag.id == PostHashtag.hashtag_id) \
+        .filter(Hashtag.name == tag.lower()).order_by(PostHashtag.created_at.desc())
+
+
+def encode_ts_cursor(ts, item_id):
+    return f"{ts.strftime('%Y%m%d%H%M%S%f')}-{item_id}"
+
+
+def decode_ts_cursor(cursor):
+    """Курсор (время, id) для keyset-пагинации списков; битый — None."""
+    if not cursor:
+        return None
+    try:
+        ts, item_id = cursor.split('-')
+        return datetime.strptime(ts, '%Y%m%d%H%M%S%f'), int(item_id)
+    except ValueError:
+        return None
+
+
+CHATS_PAGE_SIZE = 30
+CHAT_PAGE_SIZE = 50
+NOTIFICATIONS_PAGE_SIZE = 30
+EVENTS_KEEPALIVE = 15  # секунды между ping в /events
+
+
+# --- ИЗОБРАЖЕНИЯ ---
+# Ширины вариантов: лента не шире 580px (1x/2x), аватарки — квадраты 40px и 120px в профиле (1x/2x)
+POST_WIDTHS = (480, 800, 1200)
+AVATAR_WIDTHS = (48, 96, 240)
+IMAGE_KINDS = {'post': ('posts', POST_WIDTHS), 'avatar': ('avatars', AVATAR_WIDTHS)}
+MEDIA_FOLDERS = {'posts': 'UPLOAD_FOLDER_POSTS', 'avatars': 'UPLOAD_FOLDER'}  # /media/<kind>/ → ключ конфига
+MEDIA_IMMUTABLE_AGE = 365 * 24 * 3600  # имя = хэш содержимого, файл по нему не меняется
+MEDIA_LEGACY_AGE = 3600  # старые имена вида user_1.jpg
+VARIANT_RE = re.compile(r'^([0-9a-f]{16})_(\d+)\.jpg$')
+
+
+def store_original(file, prefix):
+    """Сохраняет загрузку как есть (без декодирования) и возвращает путь к исходнику."""
+    ext = file.filename.rsplit('.', 1)[1].lower()
+    name = f"{prefix}_{datetime.utcnow().strftime('%Y%m%d%H%M%S%f')}.{ext}"
+    path = os.path.join(app.config['UPLOAD_FOLDER_ORIGINALS'], name)
+    file.save(path)
+    return path
+
+
+def _save_atomic(img, dest, fmt, **options):
+    if os.path.exists(dest):
+        return  # то же содержимое уже нарезано (имя — хэш исходника)
+    tmp = dest + '.tmp'
+    img.save(tmp, fmt, **options)
+    os.replace(tmp, dest)  # читатели не увидят недописанный файл
+
+
+def render_variants(src, folder, widths, quality, square=False):
+    """Нарезает src в folder: по JPEG и WebP на каждую ширину из widths, не больше исходника;
+    длинная сторона самого большого варианта — не больше max(widths).
+    Имена — {хэш содержимого}_{ширина}.jpg/.webp; возвращает имя самого большого JPEG (его хранит модель).
+    Для JPEG draft() декодирует сразу в уменьшенном масштабе (1/2–1/8) — большие фото с телефона
+    не разворачиваются в память целиком. square — центральный квадрат (аватарки)."""
+    digest = hashlib.sha256()
+    with open(src, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            digest.update(chunk)
+    digest = digest.hexdigest()[:16]
+    with Image.open(src) as img:
+        img.draft('RGB', (max(widths), max(widths)))
+        img = ImageOps.exif_transpose(img).convert('RGB')
+    max_side = max(widths)
+    if square:
+        top = min(min(img.size), max_side)
+    else:
+        # как раньше thumbnail((1200, 1200)): ограничена длинная сторона, высокие картинки уже по ширине
+        top = min(img.width, max_side, max(1, round(img.width * max_side / img.height)))
+    img = ImageOps.fit(img, (top, top), Image.LANCZOS) if square else img
+    for w in sorted({w for w in widths if w < top} | {top}, reverse=True):
+        if img.width > w:
+            img = img.resize((w, max(1, round(img.height * w / img.width))), Image.LANCZOS)
+        base = os.path.join(folder, f'{digest}_{w}')
+        _save_atomic(img, base + '.jpg', 'JPEG', quality=quality, progressive=True)
+        _save_atomic(img, base + '.webp', 'WEBP', quality=quality - 5, method=4)
+    return f'{digest}_{top}.jpg'
+
+
+def image_variants(name, kind):
+    """[(ширина, имя JPEG, имя WebP)] для файла из render_variants; для старых одиночных файлов — None."""
+    m = VARIANT_RE.match(name or '')
+    if not m:
+        return None
+    digest, top = m.group(1), int(m.group(2))
+    widths = sorted({w for w in IMAGE_KINDS[kind][1] if w < top} | {top})
+    return [(w, f'{digest}_{w}.jpg', f'{digest}_{w}.webp') for w in widths]
+
+
+def variant_name(name, kind, width):
+    """Имя наименьшего JPEG-варианта не уже width (старые файлы — как есть)."""
+    variants = image_variants(name, kind)
+    if not variants:
+        return name
+    return next((jpg for w, jpg, webp in variants if w >= width), variants[-1][1])
+
+
+def image_url(name, kind, width):
+    return url_for('media', kind=IMAGE_KINDS[kind][0], filename=variant_name(name, kind, width))
+
+
+def image_srcset(name, kind, fmt='jpg'):
+    """srcset для <img>/<source>; пустая строка — у файла нет вариантов."""
+    folder = IMAGE_KINDS[kind][0]
+    return ', '.join(
+        f"{url_for('media', kind=folder, filename=webp if fmt == 'webp' else jpg)} {w}w"
+        for w, jpg, webp in image_variants(name, kind) or [])
+
+
+app.jinja_env.globals.update(image_url=image_url, image_srcset=image_srcset)
+
+
+def process_post_image(post_id):
+    post = db.session.get(Post, post_id)
+    if post is None:
+        return  # пост удалили, пока фото ждало очереди
+    original = os.path.join(app.config['UPLOAD_FOLDER_ORIGINALS'], post.image_original)
+    try:
+        filename = render_variants(original, app.config['UPLOAD_FOLDER_POSTS'], POST_WIDTHS, 85)
+    except Exception:
+        app.logger.exception('Не удалось обработать фото поста %s', post_id)
+        post.image_status = 'failed'
+    else:
+        post.image = filename
+        post.image_status = 'ready'
+        publish_event(post.user_id, 'image', {'post_id': post.id, 'image': variant_name(filename, 'post', 800)})
+    db.session.commit()
+
+
+def process_avatar(user_id, original):
+    filename = render_variants(original, app.config['UPLOAD_FOLDER'], AVATAR_WIDTHS, 90, square=True)
+    user = db.session.get(User, user_id)
+    if user is not None and user.avatar != filename:
+        user.avatar = filename
+        db.session.commit()
+
+
+class ImagePipeline:
+    """Пул фоновой обработки загрузок: запрос только сохраняет исходник и сразу отвечает,
+    декодирование и ресайз идут в потоках пула (PIL отпускает GIL на тяжёлых операциях)."""
+
+    def __init__(self, workers=2):
+        self.workers = workers
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args):
+        if not self.workers:
+            return self._run(fn, args)
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='images')
+        return self._executor.submit(self._run, fn, args)
+
+    def _run(self, fn, args):
+        with app.app_context():
+            try:
+                fn(*args)
+            except Exception:
+                db.session.rollback()
+                app.logger.exception('Ошибка фоновой обработки изображения')
+
+    def resume(self):
+        """После перезапуска: заново ставит в очередь посты, застрявшие в processing."""
+        for (post_id,) in db.session.query(Post.id).filter(Post.image_status == 'processing').all():
+            self.submit(process_post_image, post_id)
+
+
+image_pipeline = ImagePipeline(app.config['IMAGE_WORKERS'])
+
+
+@app.cli.command('rebuild-images')
+def rebuild_images_command():
+    """Нарезать варианты для фото и аватарок, загруженных до появления вариантов."""
+    done = 0
+    for model, column, kind, folder, widths, quality, square in [
+            (Post, Post.image, 'post', app.config['UPLOAD_FOLDER_POSTS'], POST_WIDTHS, 85, False),
+            (User, User.avatar, 'avatar', app.config['UPLOAD_FOLDER'], AVATAR_WIDTHS, 90, True)]:
+        for obj in model.query.filter(column.isnot(None)).all():
+            name = getattr(obj, column.key)
+            src = os.path.join(folder, name)
+            if image_variants(name, kind) is None and os.path.exists(src):
+                setattr(obj, column.key, render_variants(src, folder, widths, quality, square=square))
+                done += 1
+        db.session.commit()
+    print(f'Нарезано изображений: {done}')
+
+
+# --- УДАЛЕНИЕ ---
+# Пост и комментарий удаляются наборами DELETE ... WHERE ... IN по каждой зависимой таблице в одной транзакции,
+# а не загрузкой и удалением строк по одной. Файлы картинок не трогаем: имена вариантов — хэш содержимого,
+# один файл могут делить несколько постов.
+POST_DEPENDENTS = [
+    (PostLike, PostLike.post_id),
+    (Repost, Repost.post_id),
+    (PostView, PostView.post_id),
+    (SavedPost, SavedPost.post_id),
+    (PostHashtag, PostHashtag.post_id),
+    (Mention, Mention.post_id),
+    (TimelineEntry, TimelineEntry.post_id),
+]
+COMMENT_DEPENDENTS = [
+    (CommentLike, CommentLike.comment_id),
+    (Mention, Mention.comment_id),
+]
+PURGE_BATCH = 50  # постов за одну транзакцию фоновой очистки
+
+
+@event.listens_for(db.session, 'do_orm_execute')
+def _hide_deleted_posts(state):
+    """Мягко удалённые посты не видны ни одному ORM-запросу (включая JOIN и подзапросы ленты).
+    Очистке и пересчётам они нужны — им execution_options(include_deleted=True)."""
+    if (state.is_select and not state.is_column_load and not state.is_relationship_load
+            and not state.execution_options.get('include_deleted', False)):
+        state.statement = state.statement.options(
+            with_loader_criteria(Post, Post.deleted_at.is_(None), include_aliases=True))
+
+
+def _delete_where(model, criterion):
+    db.session.execute(db.delete(model).where(criterion), execution_options={'synchronize_session': False})
+
+
+def _delete_notifications(criterion):
+    """Удаляет уведомления и вычитает непрочитанные из счётчиков получателей."""
+    unread = db.session.query(Notification.user_id, func.count()) \
+        .filter(criterion, Notification.read.isnot(True)).group_by(Notification.user_id).all()
+    for user_id, n in unread:
+        bump_counter(User.unread_notifications, user_id, -n)
+    _delete_where(NotificationActor, NotificationActor.notification_id.in_(
+        db.select(Notification.id).where(criterion)))
+    _delete_where(Notification, criterion)
+
+
+def comment_subtree_ids(comment_ids):
+    """id комментариев вместе со всеми ответами на них любой глубины (рекурсивный CTE)."""
+    tree = db.select(Comment.id).where(Comment.id.in_(comment_ids)).cte('comment_tree', recursive=True)
+    tree = tree.union_all(db.select(Comment.id).where(Comment.parent_id == tree.c.id))
+    return db.session.execute(db.select(tree.c.id)).scalars().all()
+
+
+def delete_comments(comment_ids):
+    """Удаляет комментарии с ответами, их лайки, упоминания и уведомления; comment_count постов
+    уменьшается на число удалённых. Коммит — на вызывающем."""
+    ids = comment_subtree_ids(comment_ids)
+    if not ids:
+        return 0
+    per_post = db.session.query(Comment.post_id, func.count()).filter(Comment.id.in_(ids)) \
+        .group_by(Comment.post_id).all()
+    _delete_notifications(Notification.comment_id.in_(ids))
+    for model, column in COMMENT_DEPENDENTS:
+        _delete_where(model, column.in_(ids))
+    _delete_where(Comment, Comment.id.in_(ids))
+    for post_id, n in per_post:
+        bump_counter(Post.comment_count, post_id, -n)
+    return len(ids)
+
+
+def purge_posts(post_ids):
+    """Удаляет посты (в том числе мягко удалённые) и всё, что на них ссылается. Счётчик постов автора
+    не трогает — это делает delete_posts. Коммит — на вызывающем."""
+    post_ids = list(post_ids)
+    if not post_ids:
+        return
+    comment_ids = db.select(Comment.id).where(Comment.post_id.in_(post_ids))
+    _delete_notifications(or_(Notification.post_id.in_(post_ids), Notification.comment_id.in_(comment_ids)))
+    for model, column in COMMENT_DEPENDENTS:
+        _delete_where(model, column.in_(comment_ids))
+    for model, column in POST_DEPENDENTS:
+        _delete_where(model, column.in_(post_ids))
+    _delete_where(Comment, Comment.post_id.in_(post_ids))
+    _delete_where(Post, Post.id.in_(post_ids))
+
+
+def delete_posts(post_ids, deferred=None):
+    """Удаляет посты: сразу целиком или (DEFERRED_DELETE) только помечает deleted_at — пост пропадает
+    из всех запросов, а зависимые строки дочищает post_purger после commit. Коммит — на вызывающем."""
+    if deferred is None:
+        deferred = app.config['DEFERRED_DELETE']
+    post_ids = list(post_ids)
+    per_user = db.session.query(Post.user_id, func.count()).filter(Post.id.in_(post_ids)) \
+        .group_by(Post.user_id).all() if post_ids else []
+    for user_id, n in per_user:
+        bump_counter(User.post_count, user_id, -n)
+    if deferred:
+        db.session.execute(db.update(Post).where(Post.id.in_(post_ids), Post.deleted_at.is_(None))
+                           .values(deleted_at=datetime.utcnow()), execution_options={'synchronize_session': False})
+        db.session.info['wake_purger'] = True
+    else:
+        purge_posts(post_ids)
+
+
+class PostPurger:
+    """Фоновая очистка мягко удалённых постов: раз в interval секунд (или сразу после wake)
+    удаляет их пачками по PURGE_BATCH через purge_posts, каждую пачку — отдельной транзакцией."""
+
+    def __init__(self, interval=30):
+        self.interval = interval
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def wake(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='post-purger', daemon=True)
+                self._thread.start()
+        self._wakeup.set()
+
+    def run_once(self):
+        """Одна пачка; возвращает число удалённых постов."""
+        ids = db.session.execute(
+            db.select(Post.id).where(Post.deleted_at.isnot(None)).order_by(Post.deleted_at).limit(PURGE_BATCH),
+            execution_options={'include_deleted': True}).scalars().all()
+        if ids:
+            purge_posts(ids)
+            db.session.commit()
+        return len(ids)
+
+    def purge_all(self):
+        total = 0
+        while True:
+            n = self.run_once()
+            total += n
+            if n < PURGE_BATCH:
+                return total
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            with app.app_context():
+                try:
+                    self.purge_all()
+                except Exception:
+                    db.session.rollback()
+                    app.logger.exception('Ошибка фоновой очистки удалённых постов')
+
+
+post_purger = PostPurger(app.config['PURGE_INTERVAL'])
+
+
+@event.listens_for(db.session, 'after_commit')
+def _wake_purger(sess):
+    # будим только после commit: до него помеченные deleted_at строки фоновому потоку не видны
+    if sess.info.pop('wake_purger', False):
+        post_purger.wake()
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _drop_purger_wakeup(sess):
+    sess.info.pop('wake_purger', None)
+
+
+@app.cli.command('purge-deleted')
+def purge_deleted_command():
+    """Дочистить мягко удалённые посты (DEFERRED_DELETE) без запущенного сервера."""
+    print(f'Удалено постов: {post_purger.purge_all()}')
+
+
+# --- МИГРАЦИИ ---
+# Схема меняется только здесь: новая миграция — новый номер в конце списка, старые не правим.
+# Миграция видит базу такой, какой та была на её версии: никаких моделей, Model.query и живых хелперов
+# (rebuild_counters и т.п.) — только SQL или Core над frozen_table с явным списком колонок.
+# Запуск без сервера: flask --app app migrate; проверка планов запросов: flask --app app check-plans
+MIGRATIONS = []
+
+
+def migration(version, name):
+    def register(fn):
+        MIGRATIONS.append((version, name, fn))
+        return fn
+    return register
+
+
+def frozen_table(name, *columns):
+    """Таблица глазами миграции: только перечисленные колонки (имя или (имя, тип)), без модели."""
+    return db.table(name, *(db.column(*c) if isinstance(c, tuple) else db.column(c) for c in columns))
+
+
+def create_missing_indexes(*indexes):
+    """CREATE INDEX IF NOT EXISTS по явному описанию (имя, таблица, колонки...), а не по текущим моделям."""
+    for name, table, *columns in indexes:
+        cols = ', '.join(f'"{c}"' for c in columns)
+        db.session.execute(text(f'CREATE INDEX IF NOT EXISTS {name} ON "{table}" ({cols})'))
+
+
+def replace_index(name, table, *columns):
+    """Пересоздаёт индекс с новым набором колонок (CREATE INDEX IF NOT EXISTS старый не заменит)."""
+    db.session.execute(text(f'DROP INDEX IF EXISTS {name}'))
+    create_missing_indexes((name, table, *columns))
+
+
+def add_missing_columns(table, *columns):
+    """ALTER TABLE ADD COLUMN для колонок, которых ещё нет (старые базы могли получить часть из них раньше).
+    columns — DDL вида 'edited_at DATETIME'. Возвращает True, если что-то добавлено."""
+    existing = {c['name'] for c in inspect(db.session.connection()).get_columns(table)}
+    added = False
+    for ddl in columns:
+        if ddl.split()[0] not in existing:
+            db.session.execute(text(f'ALTER TABLE "{table}" ADD COLUMN {ddl}'))
+            added = True
+    return added
+
+
+@migration(1, 'legacy columns')
+def _migrate_legacy_columns():
+    add_missing_columns('verification_request', 'reason TEXT')
+    add_missing_columns('user', 'custom_status VARCHAR(100)', 'banned_until DATETIME', 'last_seen DATETIME')
+    add_missing_columns('post', 'edited_at DATETIME')
+    add_missing_columns('comment', 'edited_at DATETIME', 'parent_id INTEGER')
+
+
+@migration(2, 'denormalized counters')
+def _migrate_counters():
+    counter = 'INTEGER NOT NULL DEFAULT 0'
+    added = [
+        add_missing_columns('post', f'like_count {counter}', f'comment_count {counter}',
+                            f'repost_count {counter}', f'view_count {counter}'),
+        add_missing_columns('comment', f'like_count {counter}'),
+        add_missing_columns('user', f'follower_count {counter}', f'follows_count {counter}',
+                            f'post_count {counter}', f'unread_notifications {counter}'),
+    ]
+    if not any(added):
+        return
+    # то же, что rebuild_counters, но в схеме версии 2
+    post = frozen_table('post', 'id', 'user_id', 'like_count', 'comment_count', 'repost_count', 'view_count')
+    comment = frozen_table('comment', 'id', 'post_id', 'like_count')
+    user = frozen_table('user', 'id', 'follower_count', 'follows_count', 'post_count', 'unread_notifications')
+    post_like, repost, post_view = (frozen_table(name, 'post_id') for name in ('post_like', 'repost', 'post_view'))
+    comment_like = frozen_table('comment_like', 'comment_id')
+    follow = frozen_table('follow', 'follower_id', 'following_id')
+    notification = frozen_table('notification', 'user_id', ('read', db.Boolean))
+
+    def count_of(table, *criteria):
+        return db.select(func.count()).select_from(table).where(*criteria).scalar_subquery()
+    db.session.execute(db.update(post).values(
+        like_count=count_of(post_like, post_like.c.post_id == post.c.id),
+        comment_count=count_of(comment, comment.c.post_id == post.c.id),
+        repost_count=count_of(repost, repost.c.post_id == post.c.id),
+        view_count=count_of(post_view, post_view.c.post_id == post.c.id),
+    ))
+    db.session.execute(db.update(comment).values(
+        like_count=count_of(comment_like, comment_like.c.comment_id == comment.c.id)))
+    db.session.execute(db.update(user).values(
+        follower_count=count_of(follow, follow.c.following_id == user.c.id),
+        follows_count=count_of(follow, follow.c.follower_id == user.c.id),
+        post_count=count_of(post, post.c.user_id == user.c.id),
+        unread_notifications=count_of(notification, notification.c.user_id == user.c.id,
+                                      notification.c.read.isnot(True)),
+    ))
+
+
+@migration(3, 'notification coalescing')
+def _migrate_notification_actors():
+    add_missing_columns('notification', 'actor_count INTEGER NOT NULL DEFAULT 1', 'actor_ids VARCHAR(200)')
+
+
+@migration(4, 'conversation summaries')
+def _migrate_conversations():
+    message = frozen_table('message', 'id', 'sender_id', 'receiver_id', ('read', db.Boolean), 'created_at')
+    conversation = frozen_table('conversation', 'user_a_id', 'user_b_id', 'last_message_id', 'last_at',
+                                'unread_a', 'unread_b')
+    if (db.session.execute(db.select(conversation.c.user_a_id).limit(1)).first()
+            or not db.session.execute(db.select(message.c.id).limit(1)).first()):
+        return
+    # то же, что rebuild_conversations, но в схеме версии 4
+    first = case((message.c.sender_id < message.c.receiver_id, message.c.sender_id), else_=message.c.receiver_id)
+    second = case((message.c.sender_id < message.c.receiver_id, message.c.receiver_id), else_=message.c.sender_id)
+    pairs = db.select(
+        first.label('a'), second.label('b'), func.max(message.c.id).label('last_id'),
+        func.sum(case((and_(message.c.receiver_id == first, message.c.read.isnot(True)), 1), else_=0)).label('na'),
+        func.sum(case((and_(message.c.receiver_id == second, message.c.read.isnot(True)), 1), else_=0)).label('nb'),
+    ).group_by(first, second).subquery()
+    last = message.alias('last')
+    db.session.execute(db.insert(conversation).from_select(
+        ['user_a_id', 'user_b_id', 'last_message_id', 'last_at', 'unread_a', 'unread_b'],
+        db.select(pairs.c.a, pairs.c.b, pairs.c.last_id, last.c.created_at, pairs.c.na, pairs.c.nb)
+        .join(last, last.c.id == pairs.c.last_id)))
+
+
+@migration(5, 'hashtags and mentions')
+def _migrate_tags_and_mentions():
+    # Таблицы хэштегов/упоминаний появились позже постов — заполняем один раз (как rebuild_tags_and_mentions)
+    post = frozen_table('post', 'id', 'user_id', 'body', ('created_at', db.DateTime))
+    comment = frozen_table('comment', 'id', 'post_id', 'user_id', 'body', ('created_at', db.DateTime))
+    user = frozen_table('user', 'id', 'username')
+    hashtag = frozen_table('hashtag', 'id', 'name')
+    post_hashtag = frozen_table('post_hashtag', 'post_id', 'hashtag_id', ('created_at', db.DateTime))
+    mention = frozen_table('mention', 'user_id', 'from_user_id', 'post_id', 'comment_id', ('created_at', db.DateTime))
+    if (not db.session.execute(db.select(post.c.id).limit(1)).first()
+            or db.session.execute(db.select(post_hashtag.c.post_id).limit(1)).first()
+            or db.session.execute(db.select(mention.c.post_id).limit(1)).first()):
+        return
+    posts = db.session.execute(db.select(post)).all()
+    comments = db.session.execute(db.select(comment)).all()
+
+    tagged = [(p.id, name, p.created_at) for p in posts for name in extract_hashtags(p.body)]
+    tag_ids = dict(db.session.execute(db.select(hashtag.c.name, hashtag.c.id)).all())
+    missing = sorted({name for _, name, _ in tagged} - tag_ids.keys())
+    if missing:
+        db.session.execute(db.insert(hashtag), [{'name': name} for name in missing])
+        tag_ids = dict(db.session.execute(db.select(hashtag.c.name, hashtag.c.id)).all())
+    if tagged:
+        db.session.execute(db.insert(post_hashtag), [
+            {'post_id': post_id, 'hashtag_id': tag_ids[name], 'created_at': ts} for post_id, name, ts in tagged])
+
+    user_ids = dict(db.session.execute(db.select(user.c.username, user.c.id)).all())
+    mentions = [
+        {'user_id': user_ids[name], 'from_user_id': row.user_id, 'post_id': post_id, 'comment_id': comment_id,
+         'created_at': row.created_at}
+        for row, post_id, comment_id in [(p, p.id, None) for p in posts] + [(c, c.post_id, c.id) for c in comments]
+        for name in extract_mentions(row.body) if name in user_ids]
+    if mentions:
+        db.session.execute(db.insert(mention), mentions)
+
+
+@migration(6, 'hot path indexes')
+def _migrate_indexes():
+    # create_all не трогает существующие таблицы — индексы досоздаём сами
+    create_missing_indexes(
+        ('ix_post_user_created', 'post', 'user_id', 'created_at'),
+        ('ix_post_created', 'post', 'created_at'),
+        ('ix_follow_following', 'follow', 'following_id', 'created_at'),
+        ('ix_post_like_post', 'post_like', 'post_id'),
+        ('ix_comment_post_parent', 'comment', 'post_id', 'parent_id'),
+        ('ix_comment_parent', 'comment', 'parent_id'),
+        ('ix_comment_like_comment', 'comment_like', 'comment_id'),
+        ('ix_repost_created', 'repost', 'created_at'),
+        ('ix_repost_post', 'repost', 'post_id'),
+        ('ix_notification_user_read', 'notification', 'user_id', 'read', 'created_at'),
+        ('ix_notification_user_created', 'notification', 'user_id', 'created_at'),
+        ('ix_notification_post', 'notification', 'post_id'),
+        ('ix_message_pair', 'message', 'sender_id', 'receiver_id', 'created_at'),
+        ('ix_conversation_a_last', 'conversation', 'user_a_id', 'last_at'),
+        ('ix_conversation_b_last', 'conversation', 'user_b_id', 'last_at'),
+        ('ix_block_blocked', 'block', 'blocked_id'),
+        ('ix_saved_post_user_created', 'saved_post', 'user_id', 'created_at'),
+        ('ix_saved_post_post', 'saved_post', 'post_id'),
+        ('ix_post_hashtag_tag_created', 'post_hashtag', 'hashtag_id', 'created_at'),
+        ('ix_mention_user_created', 'mention', 'user_id', 'created_at'),
+        ('ix_mention_post_comment', 'mention', 'post_id', 'comment_id'),
+    )
+
+
+@migration(7, 'post image status')
+def _migrate_image_status():
+    add_missing_columns('post', 'image_status VARCHAR(20)', 'image_original VARCHAR(200)')
+
+
+@migration(8, 'post soft delete')
+def _migrate_post_deleted_at():
+    add_missing_columns('post', 'deleted_at DATETIME')
+    create_missing_indexes(  # фоновая очистка и каскадное удаление
+        ('ix_post_deleted', 'post', 'deleted_at'),
+        ('ix_notification_comment', 'notification', 'comment_id'),
+        ('ix_mention_comment', 'mention', 'comment_id'),
+    )
+
+
+@migration(9, 'follower timelines')
+def _migrate_timelines():
+    # таблицу создал create_all; посты, написанные до неё, раскладываем один раз
+    follow = frozen_table('follow', 'follower_id', 'following_id')
+    user = frozen_table('user', 'id', 'follower_count')
+    timeline = frozen_table('timeline_entry', 'user_id', 'kind', 'item_id', 'post_id', 'author_id', 'ts')
+    if (not db.session.execute(db.select(follow.c.follower_id).limit(1)).first()
+            or db.session.execute(db.select(timeline.c.user_id).limit(1)).first()):
+        return
+    small = db.select(user.c.id).where(user.c.follower_count <= app.config['FANOUT_LIMIT'])
+    for kind, item in ((FEED_KIND_POST, frozen_table('post', 'id', 'user_id', 'created_at')),
+                       (FEED_KIND_REPOST, frozen_table('repost', 'id', 'post_id', 'user_id', 'created_at'))):
+        post_id = item.c.id if kind == FEED_KIND_POST else item.c.post_id
+        db.session.execute(db.insert(timeline).from_select(
+            ['user_id', 'kind', 'item_id', 'post_id', 'author_id', 'ts'],
+            db.select(follow.c.follower_id, literal(kind), item.c.id, post_id, item.c.user_id, item.c.created_at)
+            .join(item, item.c.user_id == follow.c.following_id).where(item.c.user_id.in_(small))))
+
+
+@migration(10, 'notification actors')
+def _migrate_notification_actor_rows():
+    # таблицу создал create_all; для открытых склеек известны только последние авторы из actor_ids
+    notification = frozen_table('notification', 'id', 'type', ('read', db.Boolean), 'actor_ids')
+    notification_actor = frozen_table('notification_actor', 'notification_id', 'user_id')
+    rows = db.session.execute(db.select(notification.c.id, notification.c.actor_ids).where(
+        notification.c.type.in_(['like', 'repost', 'follow']), notification.c.read.isnot(True),
+        notification.c.actor_ids.isnot(None))).all()
+    seen = [{'notification_id': nid, 'user_id': int(uid)}
+            for nid, actor_ids in rows for uid in dict.fromkeys(actor_ids.split(',')) if uid]
+    if seen:
+        db.session.execute(db.insert(notification_actor), seen)
+
+
+@migration(11, 'fan-out mode')
+def _migrate_fanout_mode():
+    add_missing_columns('user', 'fanout_pulled_at DATETIME')
+    # крупные аккаунты миграция 9 не раскладывала — с этого момента их читают напрямую
+    user = frozen_table('user', 'follower_count', ('fanout_pulled_at', db.DateTime))
+    db.session.execute(db.update(user).where(user.c.follower_count > app.config['FANOUT_LIMIT'])
+                       .values(fanout_pulled_at=datetime.utcnow()))
+
+
+@migration(12, 'timeline item index')
+def _migrate_timeline_item_index():
+    # отмена репоста ищет строки по (post_id, kind, item_id)
+    replace_index('ix_timeline_post', 'timeline_entry', 'post_id', 'kind', 'item_id')
+
+
+@migration(13, 'repost author index')
+def _migrate_repost_author_index():
+    create_missing_indexes(('ix_repost_user_created', 'repost', 'user_id', 'created_at'))
+
+
+@migration(14, 'message pair by id')
+def _migrate_message_pair_index():
+    # страницы переписки идут по id, а не по created_at
+    replace_index('ix_message_pair', 'message', 'sender_id', 'receiver_id', 'id')
+
+
+def run_migrations():
+    """Создаёт недостающие таблицы и по порядку применяет ещё не применённые миграции.
+    Идемпотентно: повторный запуск ничего не делает. Возвращает имена применённых миграций."""
+    db.create_all()  # заодно создаёт/заполняет FTS-индекс (ensure_search_index)
+    done = {m.version for m in SchemaMigration.query.all()}
+    applied = []
+    for version, name, fn in sorted(MIGRATIONS, key=lambda m: m[0]):
+        if version in done:
+            continue
+        try:
+            fn()
+            db.session.add(SchemaMigration(version=version, name=name))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        applied.append(f'{version:03d} {name}')
+    return applied
+
+
+@app.cli.command('migrate')
+def migrate_command():
+    """Применить миграции схемы."""
+    applied = run_migrations()
+    for name in applied:
+        print(f'Применена миграция {name}')
+    if not applied:
+        print('Схема актуальна')
+
+
+def _plan_checks():
+    """Основные запросы маршрутов для check-plans: (название, statement). Значения параметров любые —
+    план от них не зависит."""
+    now = datetime.utcnow()
+    uid, peer, pid = 1, 2, 1
+    blocked = [peer]
+    return [
+        ('index: лента', feed_page_query(blocked, (now, FEED_KIND_POST, pid), FEED_PAGE_SIZE)),
+        ('index: подписки', following_page_query(uid, blocked, (now, FEED_KIND_POST, pid), FEED_PAGE_SIZE)),
+        ('profile: посты', Post.query.filter_by(user_id=uid).order_by(Post.created_at.desc()).statement),
+        ('blocks', db.select(Block.blocker_id, Block.blocked_id)
+            .where(or_(Block.blocker_id == uid, Block.blocked_id == uid))),
+        ('comments: верхние', _limited_comment_ids(
+            and_(Comment.post_id.in_([pid, pid + 1]), Comment.parent_id.is_(None)), Comment.post_id, COMMENTS_PREVIEW)),
+        ('comments: ответы', _limited_comment_ids(Comment.parent_id.in_([1, 2]), Comment.parent_id, REPLIES_PREVIEW)),
+        ('notifications: список', Notification.query.filter_by(user_id=uid)
+            .order_by(Notification.created_at.desc(), Notification.id.desc()).limit(NOTIFICATIONS_PAGE_SIZE).statement),
+        ('notifications: прочитать', db.update(Notification)
+            .where(Notification.user_id == uid, Notification.read.is_(False)).values(read=True)),
+        ('notify: склейка', Notification.query.filter(
+            Notification.user_id == uid, Notification.type == 'like', Notification.post_id == pid,
+            Notification.read.is_(False), Notification.created_at >= now).statement),
+        ('chats', conversations_page_query(uid, blocked, (now, 1), CHATS_PAGE_SIZE)),
+        ('chat', chat_page_query(uid, peer, CHAT_PAGE_SIZE)),
+        ('chat: раньше', chat_page_query(uid, peer, CHAT_PAGE_SIZE, before=pid)),
+        ('chat: новые', chat_page_query(uid, peer, CHAT_PAGE_SIZE, since=pid)),
+        ('followers', Follow.query.filter_by(following_id=uid).statement),
+        ('following', Follow.query.filter_by(follower_id=uid).statement),
+        ('unfollow: лента', db.delete(TimelineEntry).where(TimelineEntry.user_id == uid, TimelineEntry.author_id == peer)),
+        ('repost: отмена', db.delete(TimelineEntry).where(
+            TimelineEntry.post_id == pid, TimelineEntry.kind == FEED_KIND_REPOST, TimelineEntry.item_id == 1)),
+        ('saved', SavedPost.query.filter_by(user_id=uid).order_by(SavedPost.created_at.desc()).statement),
+        ('tag', tagged_posts_query('tag').limit(100).statement),
+        ('delete_post: лайки', db.delete(PostLike).where(PostLike.post_id == pid)),
+        ('delete_post: репосты', db.delete(Repost).where(Repost.post_id == pid)),
+        ('delete_post: закладки', db.delete(SavedPost).where(SavedPost.post_id == pid)),
+        ('delete_post: уведомления', db.delete(Notification).where(Notification.post_id == pid)),
+        ('delete_post: комментарии', db.delete(Comment).where(Comment.post_id.in_([pid]))),
+        ('delete_post: лайки комментариев', db.delete(CommentLike).where(
+            CommentLike.comment_id.in_(db.select(Comment.id).where(Comment.post_id.in_([pid]))))),
+        ('delete_comment: лайки', db.delete(CommentLike).where(CommentLike.comment_id.in_([1, 2]))),
+        ('delete_comment: упоминания', db.delete(Mention).where(Mention.comment_id.in_([1, 2]))),
+        ('delete_comment: уведомления', db.delete(Notification).where(Notification.comment_id.in_([1, 2]))),
+        ('purge: очередь', db.select(Post.id).where(Post.deleted_at.isnot(None))
+            .order_by(Post.deleted_at).limit(PURGE_BATCH)),
+    ]
+
+
+def check_query_plans():
+    """EXPLAIN QUERY PLAN для каждого запроса из _plan_checks. Возвращает [(название, строка плана)]
+    для проходов по таблице целиком: SCAN без индекса, а SCAN по индексу — если в запросе нет LIMIT
+    (обход индекса в порядке сортировки с LIMIT, как в ленте, останавливается на первых строках).
+    С LIMIT ещё и сортировку (TEMP B-TREE) строк, читаемых прямо из таблицы: она перебирает их все
+    до LIMIT. Сортировка объединения подзапросов с LIMIT (слияние веток ленты) допустима."""
+    tables = set(db.metadata.tables)
+    problems = []
+    with db.engine.connect() as conn:
+        sql = []
+
+        @event.listens_for(conn, 'before_cursor_execute', retval=True)
+        def explain(conn, cursor, statement, parameters, context, executemany):
+            sql.append(statement)
+            return 'EXPLAIN QUERY PLAN ' + statement, parameters
+
+        for name, stmt in _plan_checks():
+            rows = conn.execute(stmt).cursor.fetchall()
+            limited = ' LIMIT ' in sql[-1]
+            for row in rows:
+                detail = row[-1]
+                if limited and re.match(r'USE TEMP B-TREE FOR .*ORDER BY', detail):
+                    # внешний цикл этого уровня: таблица (или MULTI-INDEX OR) или уже ограниченный подзапрос
+                    outer = next((r[-1] for r in rows
+                                  if r[1] == row[1] and re.match(r'SCAN|SEARCH|MULTI-INDEX OR', r[-1])), '')
+                    m = re.match(r'(?:SCAN|SEARCH) (\w+)', outer)
+                    if outer.startswith('MULTI-INDEX OR') or (m and re.sub(r'_\d+$', '', m.group(1)) in tables):
+                        problems.append((name, f'{outer} + {detail}'))
+                    continue
+                m = re.match(r'SCAN (\w+)( USING (?:COVERING )?INDEX \w+)?$', detail)
+                # алиасы SQLAlchemy — post_1 и т.п.; подзапросы (anon_1) и FTS сюда не попадают
+                if not m or re.sub(r'_\d+$', '', m.group(1)) not in tables:
+                    continue
+                if m.group(2) and limited:
+                    continue
+                problems.append((name, detail))
+    return problems
+
+
+@app.cli.command('check-plans')
+def check_plans_command():
+    """Упасть, если основной запрос какого-то маршрута читает таблицу целиком."""
+    problems = check_query_plans()
+    for name, detail in problems:
+        print(f'{name}: {detail}')
+    if problems:
+        sys.exit(1)
+    print('Все запросы идут по индексам')
 
 
 # --- ROUTES ---
 @app.route('/', methods=['GET', 'POST'])
 @login_required
+@read_only
 def index():
     if request.method == 'POST':
         body = (request.form.get('body') or '').strip()
@@ -299,93 +2460,121 @@ def index():
             flash('Введите текст поста')
             return redirect(url_for('index'))
         post = Post(user_id=current_user.id, body=body)
-        if 'image' in request.files:
-            file = request.files['image']
-            if file and file.filename and allowed_file(file.filename):
-                try:
-                    filename = f"post_{current_user.id}_{datetime.utcnow().strftime('%Y%m%d%H%M%S')}.jpg"
-                    filepath = os.path.join(app.config['UPLOAD_FOLDER_POSTS'], filename)
-                    img = Image.open(file)
-                    img = img.convert('RGB')
-                    img.thumbnail((1200, 1200))
-                    img.save(filepath, 'JPEG', quality=85)
-                    post.image = filename
-                except Exception:
-                    pass
+        original = None
+        file = request.files.get('image')
+        if file and file.filename and allowed_file(file.filename):
+            original = store_original(file, f'post_{current_user.id}')
+            post.image_original = os.path.basename(original)
+            post.image_status = 'processing'
         db.session.add(post)
-        db.session.commit()
+        bump_counter(User.post_count, current_user.id, 1)
+        db.session.flush()  # нужен post.id; пост, теги, упоминания и ленты — одним commit
+        sync_post_hashtags(post)
         notify_mentions(body, current_user.id, post_id=post.id)
+        fan_out(current_user.id, FEED_KIND_POST, post.id, post.id, post.created_at)
         db.session.commit()
+        if original:
+            image_pipeline.submit(process_post_image, post.id)
+        trending.record_tags(extract_hashtags(body), post.created_at)
         return redirect(url_for('index'))
 
-    blocked_ids = get_blocked_user_ids(current_user.id)
-    all_posts = Post.query.order_by(Post.created_at.desc()).all()
-    all_reposts = Repost.query.order_by(Repost.created_at.desc()).all()
-    feed_items = []
-    for p in all_posts:
-        if p.user_id not in blocked_ids:
-            feed_items.append(('post', p, None))
-    for r in all_reposts:
-        if r.user_id not in blocked_ids and r.post.user_id not in blocked_ids:
-            feed_items.append(('repost', r.post, r))
-    feed_items.sort(key=lambda x: x[1].created_at if x[0] == 'post' else x[2].created_at, reverse=True)
-
-    for item in feed_items:
-        p = item[1]
-        if PostView.query.filter_by(post_id=p.id, user_id=current_user.id).first() is None:
-            db.session.add(PostView(post_id=p.id, user_id=current_user.id))
-    db.session.commit()
+    feed = 'following' if request.args.get('feed') == 'following' else None
+    feed_items, next_cursor = get_feed_page(current_user.id, request.args.get('cursor'), following=bool(feed))
 
     post_ids = [item[1].id for item in feed_items]
+    view_recorder.record(current_user.id, post_ids)
     liked = {r.post_id for r in PostLike.query.filter(PostLike.post_id.in_(post_ids), PostLike.user_id == current_user.id).all()}
     reposted = {r.post_id for r in Repost.query.filter(Repost.post_id.in_(post_ids), Repost.user_id == current_user.id).all()}
     saved = {s.post_id for s in SavedPost.query.filter(SavedPost.post_id.in_(post_ids), SavedPost.user_id == current_user.id).all()} if post_ids else set()
-    return render_template('index.html', feed_items=feed_items, liked=liked, reposted=reposted, saved=saved)
+    comment_trees = load_comment_trees(post_ids, limit=COMMENTS_PREVIEW, replies_limit=REPLIES_PREVIEW)
+    ctx = dict(feed_items=feed_items, liked=liked, reposted=reposted, saved=saved,
+               comment_trees=comment_trees, next_cursor=next_cursor, feed=feed)
+    if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+        # Бесконечная прокрутка: следующая страница карточек + курсор
+        return jsonify({'html': render_template('_feed_items.html', **ctx), 'next_cursor': next_cursor})
+    return render_template('index.html', **ctx)
 
 
 @app.route('/post/<int:post_id>/view')
 @login_required
 def post_view(post_id):
-    post = Post.query.get_or_404(post_id)
-    existing = PostView.query.filter_by(post_id=post_id, user_id=current_user.id).first()
-    if not existing:
-        db.session.add(PostView(post_id=post_id, user_id=current_user.id))
-        db.session.commit()
+    Post.query.get_or_404(post_id)
+    view_recorder.record(current_user.id, [post_id])
     return '', 204
 
 
+@app.route('/media/<kind>/<path:filename>')
+def media(kind, filename):
+    """Загрузки пользователей. Файлы с именем-хэшем (render_variants) кэшируются навсегда (immutable),
+    ETag — сам хэш; Range и условные запросы — через send_file. При MEDIA_SENDFILE байты отдаёт прокси."""
+    if kind not in MEDIA_FOLDERS:
+        return 'Not found', 404
+    folder = os.path.abspath(app.config[MEDIA_FOLDERS[kind]])
+    m = re.match(r'^([0-9a-f]{16}_\d+)\.(jpg|webp)$', filename)
+    if app.config['MEDIA_SENDFILE'] == 'x-accel':
+        if not os.path.isfile(safe_join(folder, filename) or ''):
+            return 'Not found', 404
+        response = Response(mimetype='image/webp' if filename.endswith('.webp') else 'image/jpeg')
+        response.headers['X-Accel-Redirect'] = f"{app.config['MEDIA_ACCEL_PREFIX']}{kind}/{filename}"
+    else:
+        response = send_from_directory(folder, filename, conditional=True,
+                                       etag=m.group(0) if m else True, max_age=MEDIA_LEGACY_AGE)
+    response.cache_control.public = True
+    if m:
+        response.cache_control.max_age = MEDIA_IMMUTABLE_AGE
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.max_age = MEDIA_LEGACY_AGE
+    return response
+
+
 @app.route('/post/<int:post_id>/like', methods=['POST'])
 @login_required
+@retry_on_busy
 def post_like(post_id):
     post = Post.query.get_or_404(post_id)
     like = PostLike.query.filter_by(post_id=post_id, user_id=current_user.id).first()
     if like:
         db.session.delete(like)
+        count = bump_counter(Post.like_count, post_id, -1)
         db.session.commit()
-        return jsonify({'liked': False, 'count': post.likes_count()})
+        return jsonify({'liked': False, 'count': count})
     db.session.add(PostLike(post_id=post_id, user_id=current_user.id))
+    count = bump_counter(Post.like_count, post_id, 1)
     notify(post.user_id, current_user.id, 'like', post_id=post_id)
+    publish_event(post.user_id, 'like', {'post_id': post_id, 'count': count})
     db.session.commit()
-    return jsonify({'liked': True, 'count': post.likes_count()})
+    trending.record_post(post_id, 'like')
+    return jsonify({'liked': True, 'count': count})
 
 
 @app.route('/post/<int:post_id>/repost', methods=['POST'])
 @login_required
+@retry_on_busy
 def post_repost(post_id):
     post = Post.query.get_or_404(post_id)
     r = Repost.query.filter_by(post_id=post_id, user_id=current_user.id).first()
     if r:
+        db.session.execute(db.delete(TimelineEntry).where(
+            TimelineEntry.post_id == post_id, TimelineEntry.kind == FEED_KIND_REPOST, TimelineEntry.item_id == r.id))
         db.session.delete(r)
+        count = bump_counter(Post.repost_count, post_id, -1)
         db.session.commit()
-        return jsonify({'reposted': False, 'count': post.reposts_count()})
-    db.session.add(Repost(post_id=post_id, user_id=current_user.id))
+        return jsonify({'reposted': False, 'count': count})
+    r = Repost(post_id=post_id, user_id=current_user.id)
+    db.session.add(r)
+    db.session.flush()
+    fan_out(current_user.id, FEED_KIND_REPOST, r.id, post_id, r.created_at)
+    count = bump_counter(Post.repost_count, post_id, 1)
     notify(post.user_id, current_user.id, 'repost', post_id=post_id)
     db.session.commit()
-    return jsonify({'reposted': True, 'count': post.reposts_count()})
+    trending.record_post(post_id, 'repost')
+    return jsonify({'reposted': True, 'count': count})
 
 
 @app.route('/post/<int:post_id>/comment', methods=['POST'])
 @login_required
+@retry_on_busy
 def post_comment(post_id):
     post = Post.query.get_or_404(post_id)
     body = (request.form.get('body') or '').strip()
@@ -401,28 +2590,45 @@ def post_comment(post_id):
         except ValueError:
             pass
     db.session.add(c)
-    db.session.commit()
+    count = bump_counter(Post.comment_count, post_id, 1)
+    db.session.flush()  # нужен c.id; commit один на всё — @retry_on_busy повторяет view целиком
     notify(post.user_id, current_user.id, 'comment', post_id=post_id, comment_id=c.id)
+    publish_event(post.user_id, 'comment', {'post_id': post_id, 'comment_id': c.id, 'count': count})
     notify_mentions(body, current_user.id, post_id=post_id, comment_id=c.id)
     db.session.commit()
+    trending.record_post(post_id, 'comment')
     return redirect(request.referrer or url_for('index'))
 
 
+@app.route('/post/<int:post_id>/comments')
+@login_required
+@read_only
+def post_comments(post_id):
+    """Полный тред поста для кнопки «Все комментарии» в карточке."""
+    post = Post.query.get_or_404(post_id)
+    thread = load_comment_trees([post.id])[post.id]
+    return jsonify({'html': render_template('_comments.html', post=post, _thread=thread)})
+
+
 @app.route('/comment/<int:comment_id>/like', methods=['POST'])
 @login_required
+@retry_on_busy
 def comment_like(comment_id):
     c = Comment.query.get_or_404(comment_id)
     like = CommentLike.query.filter_by(comment_id=comment_id, user_id=current_user.id).first()
     if like:
         db.session.delete(like)
+        count = bump_counter(Comment.like_count, comment_id, -1)
     else:
         db.session.add(CommentLike(comment_id=comment_id, user_id=current_user.id))
+        count = bump_counter(Comment.like_count, comment_id, 1)
     db.session.commit()
-    return jsonify({'count': c.likes_count()})
+    return jsonify({'count': count})
 
 
 @app.route('/follow/<int:user_id>', methods=['POST'])
 @login_required
+@retry_on_busy
 def follow(user_id):
     target = User.query.get_or_404(user_id)
     if target.id == current_user.id:
@@ -432,26 +2638,40 @@ def follow(user_id):
     f = Follow.query.filter_by(follower_id=current_user.id, following_id=target.id).first()
     if f:
         db.session.delete(f)
+        db.session.execute(db.delete(TimelineEntry).where(
+            TimelineEntry.user_id == current_user.id, TimelineEntry.author_id == target.id))
+        sync_fanout_mode(target.id, bump_counter(User.follower_count, target.id, -1))
+        bump_counter(User.follows_count, current_user.id, -1)
         db.session.commit()
         return jsonify({'following': False})
     db.session.add(Follow(follower_id=current_user.id, following_id=target.id))
+    followers = bump_counter(User.follower_count, target.id, 1)
+    bump_counter(User.follows_count, current_user.id, 1)
+    sync_fanout_mode(target.id, followers)
+    backfill_timeline(current_user.id, target.id)
     notify(target.id, current_user.id, 'follow')
+    publish_event(target.id, 'follow', {'from_user_id': current_user.id, 'followers': followers})
     db.session.commit()
     return jsonify({'following': True})
 
 
 @app.route('/tag/<path:tag>')
 @login_required
+@read_only
 def tag_page(tag):
     blocked_ids = get_blocked_user_ids(current_user.id)
-    posts = Post.query.filter(Post.body.ilike(f'%#{tag}%')).order_by(Post.created_at.desc()).limit(100).all()
-    posts = [p for p in posts if p.user_id not in blocked_ids]
+    query = tagged_posts_query(tag).options(joinedload(Post.user))
+    if blocked_ids:
+        query = query.filter(Post.user_id.notin_(blocked_ids))
+    posts = query.limit(100).all()
     post_ids = [p.id for p in posts]
     liked = {r.post_id for r in PostLike.query.filter(PostLike.post_id.in_(post_ids), PostLike.user_id == current_user.id).all()} if post_ids else set()
     reposted = {r.post_id for r in Repost.query.filter(Repost.post_id.in_(post_ids), Repost.user_id == current_user.id).all()} if post_ids else set()
     saved = {s.post_id for s in SavedPost.query.filter(SavedPost.post_id.in_(post_ids), SavedPost.user_id == current_user.id).all()} if post_ids else set()
+    comment_trees = load_comment_trees(post_ids, limit=COMMENTS_PREVIEW, replies_limit=REPLIES_PREVIEW)
     feed_items = [('post', p, None) for p in posts]
-    return render_template('tag.html', tag=tag, feed_items=feed_items, liked=liked, reposted=reposted, saved=saved)
+    return render_template('tag.html', tag=tag, feed_items=feed_items, liked=liked, reposted=reposted, saved=saved,
+                           comment_trees=comment_trees)
 
 
 @app.route('/post/<int:post_id>/edit', methods=['GET', 'POST'])
@@ -467,6 +2687,8 @@ def edit_post(post_id):
             return redirect(request.referrer or url_for('index'))
         post.body = body
         post.edited_at = datetime.utcnow()
+        sync_post_hashtags(post)
+        sync_mentions(body, post.user_id, post.id)
         db.session.commit()
         flash('Пост обновлён')
         return redirect(request.referrer or url_for('index'))
@@ -475,6 +2697,7 @@ def edit_post(post_id):
 
 @app.route('/post/<int:post_id>/save', methods=['POST'])
 @login_required
+@retry_on_busy
 def save_post(post_id):
     post = Post.query.get_or_404(post_id)
     s = SavedPost.query.filter_by(post_id=post_id, user_id=current_user.id).first()
@@ -489,6 +2712,7 @@ def save_post(post_id):
 
 @app.route('/saved')
 @login_required
+@read_only
 def saved():
     saved_list = SavedPost.query.filter_by(user_id=current_user.id).order_by(SavedPost.created_at.desc()).all()
     saved_ids = [s.post_id for s in saved_list]
@@ -499,8 +2723,10 @@ def saved():
     liked = {r.post_id for r in PostLike.query.filter(PostLike.post_id.in_(post_ids), PostLike.user_id == current_user.id).all()} if post_ids else set()
     reposted = {r.post_id for r in Repost.query.filter(Repost.post_id.in_(post_ids), Repost.user_id == current_user.id).all()} if post_ids else set()
     saved = set(post_ids)
+    comment_trees = load_comment_trees(post_ids, limit=COMMENTS_PREVIEW, replies_limit=REPLIES_PREVIEW)
     feed_items = [('post', p, None) for p in posts]
-    return render_template('saved.html', feed_items=feed_items, liked=liked, reposted=reposted, saved=saved)
+    return render_template('saved.html', feed_items=feed_items, liked=liked, reposted=reposted, saved=saved,
+                           comment_trees=comment_trees)
 
 
 @app.route('/comment/<int:comment_id>/edit', methods=['GET', 'POST'])
@@ -514,6 +2740,7 @@ def edit_comment_page(comment_id):
         if body:
             c.body = body
             c.edited_at = datetime.utcnow()
+            sync_mentions(body, c.user_id, c.post_id, c.id)
             db.session.commit()
         return redirect(request.referrer or url_for('index'))
     return render_template('edit_comment.html', comment=c)
@@ -525,9 +2752,7 @@ def delete_comment(comment_id):
     c = Comment.query.get_or_404(comment_id)
     if c.user_id != current_user.id and not current_user.is_admin:
         return "Access Denied", 403
-    for cl in CommentLike.query.filter_by(comment_id=comment_id).all():
-        db.session.delete(cl)
-    db.session.delete(c)
+    delete_comments([comment_id])
     db.session.commit()
     flash('Комментарий удалён')
     return redirect(request.referrer or url_for('index'))
@@ -543,73 +2768,210 @@ def block_user(user_id):
     if b:
         db.session.delete(b)
         db.session.commit()
+        invalidate_blocks(current_user.id, target.id)
         return jsonify({'blocked': False})
     db.session.add(Block(blocker_id=current_user.id, blocked_id=target.id))
     db.session.commit()
+    invalidate_blocks(current_user.id, target.id)
     return jsonify({'blocked': True})
 
 
+@app.route('/trending')
+@login_required
+@read_only
+def trending_json():
+    """Тренды за сутки: хэштеги и посты с очками (лайк 1, комментарий 2, репост 3)."""
+    k = min(max(request.args.get('k', 10, type=int), 1), TrendingService.TOP_KEEP)
+    top_posts = trending.top_posts(k)
+    blocked_ids = get_blocked_user_ids(current_user.id)
+    posts = {p.id: p for p in Post.query.options(joinedload(Post.user))
+             .filter(Post.id.in_([pid for pid, _ in top_posts])).all()} if top_posts else {}
+    return jsonify({
+        'tags': [{'name': name, 'score': score} for name, score in trending.top_tags(k)],
+        'posts': [{'id': pid, 'author': posts[pid].user.username, 'body': posts[pid].body[:140], 'score': score}
+                  for pid, score in top_posts if pid in posts and posts[pid].user_id not in blocked_ids],
+    })
+
+
 @app.route('/search')
 @login_required
+@read_only
 def search():
     q = (request.args.get('q') or '').strip()
+    page = max(request.args.get('page', 1, type=int), 1)
+    offset = (page - 1) * SEARCH_PAGE_SIZE
     users = []
     posts = []
     if q:
+        blocked_ids = get_blocked_user_ids(current_user.id)
         if q.startswith('#'):
             tag = q[1:].lower()
-            posts = Post.query.filter(Post.body.ilike(f'%#{tag}%')).order_by(Post.created_at.desc()).limit(50).all()
+            query = tagged_posts_query(tag).options(joinedload(Post.user))
+            if blocked_ids:
+                query = query.filter(Post.user_id.notin_(blocked_ids))
+            posts = query.limit(SEARCH_PAGE_SIZE + 1).offset(offset).all()
         else:
-            users = User.query.filter(User.username.ilike(f'%{q}%')).limit(30).all()
-            posts = Post.query.filter(Post.body.ilike(f'%{q}%')).order_by(Post.created_at.desc()).limit(30).all()
-    return render_template('search.html', q=q or '', users=users, posts=posts)
+            users = search_users(q, SEARCH_PAGE_SIZE + 1, offset, exclude_user_ids=blocked_ids)
+            posts = search_posts(q, SEARCH_PAGE_SIZE + 1, offset, exclude_user_ids=blocked_ids)
+    # +1 строка — только чтобы понять, есть ли следующая страница
+    has_next = len(users) > SEARCH_PAGE_SIZE or len(posts) > SEARCH_PAGE_SIZE
+    users, posts = users[:SEARCH_PAGE_SIZE], posts[:SEARCH_PAGE_SIZE]
+    return render_template('search.html', q=q or '', users=users, posts=posts,
+                           page=page, has_next=has_next)
 
 
 @app.route('/notifications')
 @login_required
 def notifications():
-    Notification.query.filter_by(user_id=current_user.id, read=False).update({'read': True})
-    db.session.commit()
-    items = Notification.query.filter_by(user_id=current_user.id).order_by(Notification.created_at.desc()).limit(100).all()
-    return render_template('notifications.html', notifications=items)
+    if current_user.unread_notifications:
+        Notification.query.filter_by(user_id=current_user.id, read=False).update({'read': True})
+        current_user.unread_notifications = 0
+        db.session.commit()
+    query = Notification.query.options(joinedload(Notification.from_user)).filter_by(user_id=current_user.id)
+    cursor = decode_ts_cursor(request.args.get('cursor'))
+    if cursor:
+        query = query.filter(or_(Notification.created_at < cursor[0],
+                                 and_(Notification.created_at == cursor[0], Notification.id < cursor[1])))
+    rows = query.order_by(Notification.created_at.desc(), Notification.id.desc()) \
+        .limit(NOTIFICATIONS_PAGE_SIZE + 1).all()
+    items = rows[:NOTIFICATIONS_PAGE_SIZE]
+    next_cursor = encode_ts_cursor(items[-1].created_at, items[-1].id) if len(rows) > NOTIFICATIONS_PAGE_SIZE else None
+    # Авторы склеенных уведомлений — одним запросом на страницу
+    actor_ids = {uid for n in items for uid in n.recent_actor_ids()[:2]}
+    actors = {u.id: u for u in User.query.filter(User.id.in_(actor_ids)).all()} if actor_ids else {}
+    return render_template('notifications.html', notifications=items, actors=actors, next_cursor=next_cursor)
+
+
+def conversations_page_query(user_id, blocked_ids, cursor, limit):
+    """SELECT Conversation одной страницы /chats (last_at desc): по ветке на сторону пары, каждая —
+    LIMIT по своему индексу (ix_conversation_a_last / _b_last), сортируется только их объединение."""
+    branches = []
+    for own, other in ((Conversation.user_a_id, Conversation.user_b_id),
+                       (Conversation.user_b_id, Conversation.user_a_id)):
+        query = db.select(Conversation).where(own == user_id)
+        if own is Conversation.user_b_id:
+            query = query.where(other != user_id)  # диалог с самим собой — только в первой ветке
+        if blocked_ids:
+            query = query.where(other.notin_(blocked_ids))
+        if cursor:
+            query = query.where(or_(Conversation.last_at < cursor[0],
+                                    and_(Conversation.last_at == cursor[0], Conversation.id < cursor[1])))
+        branches.append(query.order_by(Conversation.last_at.desc(), Conversation.id.desc()).limit(limit + 1).subquery())
+    conv = aliased(Conversation, union_all(*[db.select(b) for b in branches]).subquery())
+    return db.select(conv).options(joinedload(conv.user_a), joinedload(conv.user_b), joinedload(conv.last_message)) \
+        .order_by(conv.last_at.desc(), conv.id.desc()).limit(limit + 1)
 
 
 @app.route('/chats')
 @login_required
 def chats():
-    blocked_ids = get_blocked_user_ids(current_user.id)
-    msgs = Message.query.filter(
-        or_(Message.sender_id == current_user.id, Message.receiver_id == current_user.id)
-    ).order_by(Message.created_at.desc()).all()
-    seen = set()
-    convos = []
-    for m in msgs:
-        pid = m.receiver_id if m.sender_id == current_user.id else m.sender_id
-        if pid not in seen and pid not in blocked_ids:
-            seen.add(pid)
-            convos.append((User.query.get(pid), m))
-    return render_template('chats.html', convos=convos)
+    cursor = decode_ts_cursor(request.args.get('cursor'))
+    rows = db.session.execute(conversations_page_query(
+        current_user.id, get_blocked_user_ids(current_user.id), cursor, CHATS_PAGE_SIZE)).scalars().all()
+    next_cursor = encode_ts_cursor(rows[CHATS_PAGE_SIZE - 1].last_at, rows[CHATS_PAGE_SIZE - 1].id) \
+        if len(rows) > CHATS_PAGE_SIZE else None
+    convos = [(c.peer_of(current_user.id), c.last_message, c.unread_for(current_user.id))
+              for c in rows[:CHATS_PAGE_SIZE] if c.last_message]
+    return render_template('chats.html', convos=convos, next_cursor=next_cursor)
+
+
+def chat_page_query(user_id, peer_id, limit, before=None, since=None):
+    """SELECT limit + 1 сообщений переписки: по ветке на направление, каждая — LIMIT по ix_message_pair
+    в порядке id, сортируется только их объединение (как в feed_page_query).
+    Без since — самые новые (старше before, если задан), id desc; since — следующие после него, id asc."""
+    branches = []
+    for sender_id, receiver_id in {(user_id, peer_id), (peer_id, user_id)}:
+        query = db.select(Message).where(Message.sender_id == sender_id, Message.receiver_id == receiver_id)
+        if since is not None:
+            query = query.where(Message.id > since).order_by(Message.id.asc())
+        else:
+            if before is not None:
+                query = query.where(Message.id < before)
+            query = query.order_by(Message.id.desc())
+        branches.append(query.limit(limit + 1).subquery())
+    msg = aliased(Message, union_all(*[db.select(b) for b in branches]).subquery())
+    return db.select(msg).order_by(msg.id.asc() if since is not None else msg.id.desc()).limit(limit + 1)
 
 
 @app.route('/chat/<int:user_id>', methods=['GET', 'POST'])
 @login_required
+@retry_on_busy
 def chat(user_id):
     peer = User.query.get_or_404(user_id)
     if is_blocked(current_user.id, peer.id):
+        if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+            return jsonify({'error': 'blocked'}), 403
         flash('Чат недоступен')
         return redirect(url_for('chats'))
     if request.method == 'POST':
         body = (request.form.get('body') or '').strip()
         if body:
-            db.session.add(Message(sender_id=current_user.id, receiver_id=user_id, body=body))
+            m = Message(sender_id=current_user.id, receiver_id=user_id, body=body)
+            db.session.add(m)
+            db.session.flush()
+            touch_conversation(m)
+            for uid in {current_user.id, user_id}:
+                publish_event(uid, 'message', {'id': m.id, 'sender_id': current_user.id, 'receiver_id': user_id})
             db.session.commit()
+        if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+            return jsonify({'ok': bool(body)})
         return redirect(url_for('chat', user_id=user_id))
-    messages = Message.query.filter(
-        or_(
-            and_(Message.sender_id == current_user.id, Message.receiver_id == user_id),
-            and_(Message.sender_id == user_id, Message.receiver_id == current_user.id)
-    )).order_by(Message.created_at.asc()).all()
-    return render_template('chat.html', peer=peer, messages=messages)
+    mark_conversation_read(current_user.id, peer.id)
+    # Только последние CHAT_PAGE_SIZE сообщений; старые — через /chat/<id>/messages?before=
+    rows = db.session.execute(chat_page_query(current_user.id, peer.id, CHAT_PAGE_SIZE)).scalars().all()
+    has_more = len(rows) > CHAT_PAGE_SIZE
+    messages = rows[:CHAT_PAGE_SIZE][::-1]
+    return render_template('chat.html', peer=peer, messages=messages, has_more=has_more)
+
+
+@app.route('/chat/<int:user_id>/messages')
+@login_required
+def chat_messages(user_id):
+    """Кусок истории в JSON: ?before=<id> — предыдущая страница, ?since=<id> — всё новое после id."""
+    peer = User.query.get_or_404(user_id)
+    if is_blocked(current_user.id, peer.id):
+        return jsonify({'error': 'blocked'}), 403
+    before = request.args.get('before', type=int)
+    since = request.args.get('since', type=int)
+    rows = db.session.execute(chat_page_query(
+        current_user.id, peer.id, CHAT_PAGE_SIZE, before=before, since=since)).scalars().all()
+    has_more = len(rows) > CHAT_PAGE_SIZE
+    if since is not None:
+        messages = rows[:CHAT_PAGE_SIZE]
+        if any(m.sender_id == peer.id for m in messages):
+            mark_conversation_read(current_user.id, peer.id)
+    else:
+        messages = rows[:CHAT_PAGE_SIZE][::-1]
+    return jsonify({
+        'html': render_template('_chat_messages.html', messages=messages),
+        'first_id': messages[0].id if messages else None,
+        'last_id': messages[-1].id if messages else None,
+        'has_more': has_more,
+    })
+
+
+@app.route('/events')
+@login_required
+def events():
+    """Server-Sent Events: новые сообщения, уведомления, лайки и подписки одним долгим соединением."""
+    user_id = current_user.id
+    q = broker.subscribe(user_id)
+
+    def stream():
+        try:
+            yield 'retry: 5000\n\n'
+            while True:
+                try:
+                    message = q.get(timeout=EVENTS_KEEPALIVE)
+                except queue.Empty:
+                    yield ': ping\n\n'  # держим соединение через прокси
+                    continue
+                yield f"event: {message['type']}\ndata: {json.dumps(message['data'])}\n\n"
+        finally:
+            broker.unsubscribe(user_id, q)
+
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 
 def _generate_code():
@@ -739,15 +3101,6 @@ def login():
     return render_template('login.html')
 
 
-@app.before_request
-def check_banned():
-    if current_user.is_authenticated and getattr(current_user, 'banned_until', None) and current_user.banned_until and current_user.banned_until > datetime.utcnow():
-        from flask_login import logout_user
-        logout_user()
-        flash('Ваш аккаунт заблокирован. Ожидайте окончания блокировки.')
-        return redirect(url_for('login'))
-
-
 @app.route('/logout')
 @login_required
 def logout():
@@ -757,6 +3110,7 @@ def logout():
 
 @app.route('/u/<username>')
 @login_required
+@read_only
 def profile(username):
     user = User.query.filter_by(username=username).first_or_404()
     if is_blocked(current_user.id, user.id):
@@ -764,26 +3118,25 @@ def profile(username):
         return redirect(url_for('index'))
     posts = Post.query.filter_by(user_id=user.id).order_by(Post.created_at.desc()).all()
     is_following = Follow.query.filter_by(follower_id=current_user.id, following_id=user.id).first() is not None
-    is_blocking = Block.query.filter_by(blocker_id=current_user.id, blocked_id=user.id).first() is not None
+    blocking = is_blocking(current_user.id, user.id)
     post_ids = [p.id for p in posts]
     liked = {r.post_id for r in PostLike.query.filter(PostLike.post_id.in_(post_ids), PostLike.user_id == current_user.id).all()} if post_ids else set()
     reposted = {r.post_id for r in Repost.query.filter(Repost.post_id.in_(post_ids), Repost.user_id == current_user.id).all()} if post_ids else set()
     saved = {s.post_id for s in SavedPost.query.filter(SavedPost.post_id.in_(post_ids), SavedPost.user_id == current_user.id).all()} if post_ids else set()
-    # Онлайн-статус для профиля
-    is_online = False
-    last_seen_human = ''
-    if getattr(user, 'last_seen', None):
-        delta = datetime.utcnow() - user.last_seen
-        is_online = delta.total_seconds() < 120
-        last_seen_human = time_ago(user.last_seen)
+    comment_trees = load_comment_trees(post_ids, limit=COMMENTS_PREVIEW, replies_limit=REPLIES_PREVIEW)
+    # Онлайн-статус для профиля — из трекера, без ожидания записи в БД
+    last_seen = presence.last_seen(user)
+    is_online = presence.is_online(user)
+    last_seen_human = time_ago(last_seen) if last_seen else ''
     return render_template('profile.html', user=user, posts=posts,
-                           is_following=is_following, is_blocking=is_blocking,
-                           liked=liked, reposted=reposted, saved=saved,
-                           is_online=is_online, last_seen_human=last_seen_human)
+                           is_following=is_following, is_blocking=blocking,
+                           liked=liked, reposted=reposted, saved=saved, comment_trees=comment_trees,
+                           last_seen=last_seen, is_online=is_online, last_seen_human=last_seen_human)
 
 
 @app.route('/u/<username>/followers')
 @login_required
+@read_only
 def followers(username):
     user = User.query.filter_by(username=username).first_or_404()
     fol = Follow.query.filter_by(following_id=user.id).all()
@@ -794,6 +3147,7 @@ def followers(username):
 
 @app.route('/u/<username>/following')
 @login_required
+@read_only
 def following(username):
     user = User.query.filter_by(username=username).first_or_404()
     fol = Follow.query.filter_by(follower_id=user.id).all()
@@ -821,17 +3175,7 @@ def delete_post(post_id):
     post = Post.query.get_or_404(post_id)
     if post.user_id != current_user.id and not current_user.is_admin:
         return "Access Denied", 403
-    for c in list(post.comments.all()):
-        for cl in CommentLike.query.filter_by(comment_id=c.id).all():
-            db.session.delete(cl)
-        db.session.delete(c)
-    for pl in PostLike.query.filter_by(post_id=post_id).all():
-        db.session.delete(pl)
-    for r in Repost.query.filter_by(post_id=post_id).all():
-        db.session.delete(r)
-    for pv in PostView.query.filter_by(post_id=post_id).all():
-        db.session.delete(pv)
-    db.session.delete(post)
+    delete_posts([post_id])
     db.session.commit()
     flash('Пост удалён')
     return redirect(request.referrer or url_for('index'))
@@ -871,20 +3215,11 @@ def settings():
     if request.method == 'POST':
         user = User.query.get(current_user.id)
         user.bio = request.form.get('bio')
-        if 'avatar' in request.files:
-            file = request.files['avatar']
-            if file and file.filename and allowed_file(file.filename):
-                try:
-                    filename = f"user_{user.id}.jpg"
-                    filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                    img = Image.open(file)
-                    img = img.convert('RGB')
-                    img.thumbnail((400, 400))
-                    img.save(filepath, 'JPEG', quality=90)
-                    user.avatar = filename
-                except Exception:
-                    flash('Не удалось загрузить фото')
         db.session.commit()
+        file = request.files.get('avatar')
+        if file and file.filename and allowed_file(file.filename):
+            image_pipeline.submit(process_avatar, user.id, store_original(file, f'user_{user.id}'))
+            flash('Фото загружено и появится через несколько секунд')
         return redirect(url_for('profile', username=user.username))
     pending = VerificationRequest.query.filter_by(user_id=current_user.id, status='pending').first()
     return render_template('settings.html', pending=pending)
@@ -1027,7 +3362,8 @@ app.jinja_env.filters['linkify'] = linkify_post
 def inject_globals():
     d = {'predefined_statuses': PREDEFINED_STATUSES}
     if current_user.is_authenticated:
-        d['notifications_count'] = min(Notification.query.filter_by(user_id=current_user.id, read=False).count(), 99)
+        d['notifications_count'] = min(current_user.unread_notifications or 0, 99)
+        d['trending_tags'] = trending.top_tags(5)
     else:
         d['notifications_count'] = 0
     return d
@@ -1035,48 +3371,8 @@ def inject_globals():
 
 if __name__ == '__main__':
     with app.app_context():
-        db.create_all()
-        try:
-            from sqlalchemy import text
-            db.session.execute(text('ALTER TABLE verification_request ADD COLUMN reason TEXT'))
-            db.session.commit()
-        except Exception:
-            db.session.rollback()
-        try:
-            from sqlalchemy import text
-            db.session.execute(text('ALTER TABLE user ADD COLUMN custom_status VARCHAR(100)'))
-            db.session.commit()
-        except Exception:
-            db.session.rollback()
-        try:
-            from sqlalchemy import text
-            db.session.execute(text('ALTER TABLE user ADD COLUMN banned_until DATETIME'))
-            db.session.commit()
-        except Exception:
-            db.session.rollback()
-        try:
-            from sqlalchemy import text
-            db.session.execute(text('ALTER TABLE post ADD COLUMN edited_at DATETIME'))
-            db.session.commit()
-        except Exception:
-            db.session.rollback()
-        try:
-            from sqlalchemy import text
-            db.session.execute(text('ALTER TABLE comment ADD COLUMN edited_at DATETIME'))
-            db.session.commit()
-        except Exception:
-            db.session.rollback()
-        # Новые колонки для last_seen и parent_id
-        try:
-            from sqlalchemy import text
-            db.session.execute(text('ALTER TABLE user ADD COLUMN last_seen DATETIME'))
-            db.session.commit()
-        except Exception:
-            db.session.rollback()
-        try:
-            from sqlalchemy import text
-            db.session.execute(text('ALTER TABLE comment ADD COLUMN parent_id INTEGER'))
-            db.session.commit()
-        except Exception:
-            db.session.rollback()
+        run_migrations()
+        image_pipeline.resume()
+    if app.config['DEFERRED_DELETE']:
+        post_purger.wake()
     app.run(debug=True)
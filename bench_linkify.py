@@ -0,0 +1,57 @@
+"""Бенчмарк фильтра linkify: рендер ленты из 100 постов (по 5 комментариев) без кэша и с кэшем.
+Запуск: python bench_linkify.py — базу не трогает."""
+import random
+import timeit
+
+from app import app, _linkify_cached, linkify_post
+
+POSTS = 100
+COMMENTS_PER_POST = 5
+ROUNDS = 50
+
+WORDS = ['привет', 'всем', 'сегодня', 'azaynur', 'лента', 'hello', 'world', 'фото', 'новости', 'day']
+
+
+def make_text(rnd, n_words):
+    parts = []
+    for _ in range(n_words):
+        roll = rnd.random()
+        if roll < 0.1:
+            parts.append('#' + rnd.choice(WORDS))
+        elif roll < 0.15:
+            parts.append('@user' + str(rnd.randint(1, 50)))
+        else:
+            parts.append(rnd.choice(WORDS))
+    return ' '.join(parts)
+
+
+def main():
+    rnd = random.Random(42)
+    texts = []
+    for i in range(POSTS):
+        texts.append(make_text(rnd, 60) + f' #{i}')
+        texts += [make_text(rnd, 15) + f' {i}-{j}' for j in range(COMMENTS_PER_POST)]
+    template = app.jinja_env.from_string('{% for t in texts %}<p>{{ t|linkify }}</p>{% endfor %}')
+
+    def render():
+        return template.render(texts=texts)
+
+    def render_uncached():
+        _linkify_cached.cache_clear()
+        return render()
+
+    assert render_uncached() == render()
+    assert linkify_post('<b>#тег</b> @bob') == (
+        '&lt;b&gt;<a href="/tag/%D1%82%D0%B5%D0%B3" class="hashtag">#тег</a>&lt;/b&gt; '
+        '<a href="/u/bob" class="mention">@bob</a>')
+
+    cold = min(timeit.repeat(render_uncached, number=1, repeat=ROUNDS))
+    render()
+    warm = min(timeit.repeat(render, number=1, repeat=ROUNDS))
+    print(f'Лента: {POSTS} постов, {POSTS * COMMENTS_PER_POST} комментариев, лучший из {ROUNDS} прогонов')
+    print(f'  без кэша: {cold * 1000:.2f} мс')
+    print(f'  с кэшем:  {warm * 1000:.2f} мс  (x{cold / warm:.1f})')
+
+
+if __name__ == '__main__':
+    main()